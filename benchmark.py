@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+# Author: Nick Waterton <n.waterton@outlook.com>
+# Description: benchmarks for vegehubserver2.py
+# N Waterton 17th October 2026 V1.0: initial release, timestamp parsing
+# N Waterton 17th October 2026 V1.1: added schema validation
+# N Waterton 17th October 2026 V1.2: added load test of gateserver with a stand in MQTT broker
+# N Waterton 17th October 2026 V1.3: load test with worker processes
+# N Waterton 17th October 2026 V1.4: added memory use of settings and updates (dicts vs models)
+# N Waterton 17th October 2026 V1.5: added json libraries
+# N Waterton 17th October 2026 V1.6: added startup time
+
+import os, sys, time, timeit, json, random, socket, tempfile, tracemalloc
+import argparse
+import asyncio
+import datetime as dt
+from aiohttp import ClientSession
+
+import vegehubserver2 as vhs
+
+__version__ = __VERSION__ = "1.6.0"
+
+def backlog(count=500, start=None, rng=None):
+    '''
+    return list of updates as sent by a hub after an outage, one per minute
+    values vary if rng (random.Random) is given
+    '''
+    start = start or dt.datetime(2025, 6, 17, 13, 0, 0)
+    if rng is None:
+        return [{"created_at": (start + dt.timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S'),
+                 "field2": 2.563,
+                 "field3": 0.38,
+                 "field4": 2.831,
+                 "field5": 12.419} for i in range(count)]
+    return [{"created_at": (start + dt.timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S'),
+             "field2": rng.choice([0.082, 2.563]),
+             "field3": round(rng.uniform(0, 3.3), 3),
+             "field4": round(rng.uniform(0, 3.3), 3),
+             "field5": round(rng.uniform(11.5, 13.5), 3)} for i in range(count)]
+
+def sample_hub(mac='F8F005AD7A0A', api_key='gate', slots=4):
+    '''
+    return configuration for a hub as sent to /configin (see spec.json)
+    '''
+    return {"api_key": api_key,
+            "mac": mac,
+            "route_key": "route",
+            "updated": "2025-06-17T13:26:55.000Z",
+            "who_updated": 1,
+            "hub": {"model": "VG-HUB4-RELAY",
+                    "firmware_version": "3.9",
+                    "wifi_version": "1.2",
+                    "utc_offset": -14400,
+                    "name": api_key,
+                    "sample_period": 300,
+                    "update_period": 600,
+                    "blink_update": 1,
+                    "report_voltage": 1,
+                    "server_url": "http://192.168.100.113:8060",
+                    "static_ip_addr": "",
+                    "dns": "",
+                    "subnet": "",
+                    "gateway": "",
+                    "current_ip_addr": "192.168.100.127",
+                    "power_mode": 0},
+            "sensors": [{"slot": i, "mode": 1, "warm_up": 0.9, "pull_up": 0, "always_power": 0, "update_on_trigger": 0, "edge": 2} for i in range(slots)],
+            "actuators": [{"name": "relay {}".format(i), "slot": i, "type": 0, "enabled": 1, "mode": 0, "url": "", "url_param": "",
+                           "turn_on": 1, "time_dependent": 0, "start_time": "00:00", "end_time": "23:59", "days_of_week": 127,
+                           "conditions": [{"sequence": 0, "slot": i, "operator": 0, "lower": 1.5, "upper": 3.0, "hysteresis": 0.1, "chain": 0}]} for i in range(slots)],
+            "schedules": [{"name": "schedule {}".format(i), "idx": i, "enabled": 0, "mode": 0, "days_of_week": 127, "period": 3600, "start_time": "06:00",
+                           "actions": [{"enabled": 1, "actuator_slot": i, "duration": 10}]} for i in range(slots)],
+            "web_conditions": [],
+            "schedule_overrides": []}
+
+def sample_settings(hubs=10):
+    '''
+    return settings for a number of hubs, as stored in config.json
+    '''
+    return {'{:012X}'.format(i): sample_hub('{:012X}'.format(i), 'hub{}'.format(i)) for i in range(hubs)}
+
+def report(name, seconds, count, unit='update'):
+    print('{:<40} {:>10.2f} us/{}  ({:,.0f}/s)'.format(name, seconds/count*1e6, unit, count/seconds))
+    
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+    
+def memory_mb():
+    '''
+    return resident memory of this process in MB
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3    #peak, in KB on linux
+        
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+        
+class mqtt_sink():
+    '''
+    stand in MQTT broker, accepts connections and subscriptions, and counts (qos 0) publishes
+    '''
+    def __init__(self):
+        self.published = 0
+        self.server = None
+        self.writers = set()
+        
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+        
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                packet_type = (await reader.readexactly(1))[0] >> 4
+                length = shift = 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length |= (byte & 127) << shift
+                    shift += 7
+                    if not byte & 128:
+                        break
+                body = await reader.readexactly(length)
+                if packet_type == 1:    #CONNECT
+                    writer.write(b'\x20\x02\x00\x00')
+                elif packet_type == 3:  #PUBLISH
+                    self.published += 1
+                elif packet_type == 8:  #SUBSCRIBE
+                    writer.write(b'\x90\x03' + body[:2] + b'\x00')
+                elif packet_type == 12: #PINGREQ
+                    writer.write(b'\xd0\x00')
+                elif packet_type == 14: #DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        self.writers.discard(writer)
+        writer.close()
+        
+    async def close(self):
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await asyncio.sleep(0)
+        
+def load_requests(scenario, arg, rng):
+    '''
+    return list of (path, encoded body) for load scenario
+    periodic: one update per POST, from each hub in turn
+    backlog: every hub sends a backlog of arg.count updates at once (eg after an outage)
+    configin: hubs send their configuration, with changed settings
+    '''
+    hubs = list(sample_settings(arg.hubs).values())
+    start = dt.datetime(2025, 6, 17, 13, 0, 0)
+    requests = []
+    if scenario == 'periodic':
+        for i in range(arg.requests):
+            hub = hubs[i % len(hubs)]
+            requests.append(('/', {'key': hub['api_key'], 'updates': backlog(1, start + dt.timedelta(minutes=i // len(hubs)), rng)}))
+    elif scenario == 'backlog':
+        for hub in hubs:
+            requests.append(('/', {'key': hub['api_key'], 'updates': backlog(arg.count, start, rng)}))
+    elif scenario == 'configin':
+        for i in range(arg.requests):
+            hub = dict(hubs[i % len(hubs)])
+            hub['hub'] = dict(hub['hub'], sample_period=rng.choice([60, 300, 600, 900]))
+            requests.append(('/configin', hub))
+    return [(path, json.dumps(body).encode()) for path, body in requests]
+    
+async def loop_lag(lags, interval=0.01):
+    '''
+    measure event loop lag, the time a sleep of interval overruns by
+    '''
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+        
+async def run_load(scenario, arg):
+    '''
+    run gateserver (in this process) with a stand in MQTT broker, send the requests for scenario
+    at arg.concurrency, and return results
+    '''
+    requests = load_requests(scenario, arg, random.Random(arg.seed))
+    sink = mqtt_sink()
+    mqtt_port = await sink.start()
+    port = free_port()
+    url = 'http://127.0.0.1:{}'.format(port)
+    with tempfile.TemporaryDirectory() as tmp:
+        config = os.path.join(tmp, 'config.json')
+        with open(config, 'w') as f:
+            json.dump(sample_settings(arg.hubs), f)
+        server = vhs.gateserver(webport=[port], arg=argparse.Namespace(config=config, broker='127.0.0.1', port=mqtt_port, user=None, password=None,
+                                                                      pub_topic='/vegehub_status/', sub_topic='/vegehub_config/', queue_size=arg.queue_size, workers=arg.workers, mqtt_buffer=arg.mqtt_buffer))
+        async with ClientSession() as session:
+            for i in range(100):
+                try:
+                    async with session.get(url + '/api/getversion') as r:
+                        if r.status == 200 and server.mqtt_connected and server.publish_task and server.publish_task.done() and (not server.coordinator or len(server.coordinator.writers) == arg.workers):
+                            break
+                except OSError:
+                    pass
+                await asyncio.sleep(0.05)
+            published = server.mqtt_stats['published']
+            dropped = server.mqtt_stats['dropped']
+            memory = memory_mb()
+            latencies = []
+            errors = []
+            lags = []
+            pending = iter(requests)
+            
+            async def client():
+                for path, body in pending:
+                    start = time.perf_counter()
+                    async with session.post(url + path, data=body, headers={'Content-Type': 'application/json'}) as r:
+                        await r.read()
+                        if r.status != 200:
+                            errors.append(r.status)
+                    latencies.append(time.perf_counter() - start)
+                
+            monitor = asyncio.create_task(loop_lag(lags))
+            start = time.perf_counter()
+            await asyncio.gather(*[client() for i in range(arg.concurrency)])
+            if server.ingest_queue:
+                await server.ingest_queue.join()
+            elapsed = time.perf_counter() - start
+            count = -1
+            while (server.mqtt_buffer or count != server.mqtt_stats['published']) and time.perf_counter() - start < elapsed + 30:
+                count = server.mqtt_stats['published']
+                await asyncio.sleep(0.05)   #wait for messages from workers
+            monitor.cancel()
+        results = {'requests': len(requests), 'updates': sum(body.count(b'created_at') for path, body in requests), 'errors': errors,
+                   'elapsed': elapsed, 'latencies': latencies, 'lags': lags, 'memory': (memory, memory_mb()),
+                   'mqtt': server.mqtt_stats['published'] - published, 'dropped': server.mqtt_stats['dropped'] - dropped}
+        await server.cancel()
+    await sink.close()
+    results['received'] = sink.published
+    return results
+
+async def run_startup(arg, config, sink, mqtt_port):
+    '''
+    start vegehubserver2.py in a new process with config, and return seconds until it accepts a connection,
+    answers a request (after loading settings), and has published the config topics to sink (on mqtt_port)
+    '''
+    port = free_port()
+    url = 'http://127.0.0.1:{}'.format(port)
+    sink.published = 0
+    times = {}
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(sys.executable, os.path.join(vhs.BASE_DIR, 'vegehubserver2.py'), str(port), '-cf', config,
+                                                   '-b', '127.0.0.1', '-p', str(mqtt_port),
+                                                   '-pr', str(arg.publish_rate), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    
+    async def accept():
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                times['accept'] = time.perf_counter() - start
+                writer.close()
+                return
+            except OSError:
+                await asyncio.sleep(0.001)
+                
+    async def respond():
+        async with ClientSession() as session:
+            while True:
+                try:
+                    async with session.get(url + '/api/getversion') as r:
+                        if r.status == 200:
+                            times['response'] = time.perf_counter() - start
+                            return
+                except OSError:
+                    pass
+                await asyncio.sleep(0.001)
+                
+    async def published():
+        async for line in process.stderr:
+            if b'config topics in' in line:
+                times['published'] = time.perf_counter() - start
+                return
+        
+    try:
+        await asyncio.wait_for(asyncio.gather(accept(), respond(), published()), 600)
+    finally:
+        process.terminate()
+        await process.communicate()
+    times['topics'] = sink.published
+    return times
+    
+def bench_startup(arg):
+    '''
+    start the server with a config of arg.hubs hubs and a stand in MQTT broker, and report the time (from
+    starting python) to the first accepted connection, first response and all config topics published
+    '''
+    async def run():
+        sink = mqtt_sink()
+        mqtt_port = await sink.start()
+        with tempfile.TemporaryDirectory() as tmp:
+            config = os.path.join(tmp, 'config.json')
+            with open(config, 'w') as f:
+                json.dump(sample_settings(arg.hubs), f)
+            size = os.path.getsize(config)
+            runs = [await run_startup(arg, config, sink, mqtt_port) for i in range(arg.repeat)]
+        await sink.close()
+        return size, runs
+        
+    size, runs = asyncio.run(run())
+    print('startup: {} hubs, {:,} bytes of config, publish rate {}'.format(arg.hubs, size, '{:g}/s'.format(arg.publish_rate) if arg.publish_rate > 0 else 'unlimited'))
+    print('  first accept      {:>10.2f} ms'.format(min(r['accept'] for r in runs)*1000))
+    print('  first response    {:>10.2f} ms'.format(min(r['response'] for r in runs)*1000))
+    print('  config published  {:>10.2f} ms  ({:,} topics received by broker)'.format(min(r['published'] for r in runs)*1000, runs[-1]['topics']))
+    
+def bench_timestamps(arg):
+    '''
+    compare strptime + fixed offset (V2.4) with cached utc_to_local
+    each update timestamp is parsed once per decoder (gate, light, battery)
+    '''
+    updates = backlog(arg.count)
+    tz_offset = dt.datetime.now() - dt.datetime.utcnow()
+
+    def old():
+        for update in updates:
+            for i in range(3):
+                (dt.datetime.strptime(update['created_at'], '%Y-%m-%d %H:%M:%S')+tz_offset).isoformat()
+
+    def uncached():
+        for update in updates:
+            for i in range(3):
+                vhs.utc_to_local.__wrapped__(update['created_at'])
+
+    def cached():
+        vhs.utc_to_local.cache_clear()
+        for update in updates:
+            for i in range(3):
+                vhs.utc_to_local(update['created_at'])
+
+    print('timestamps: {} updates, 3 decoders'.format(arg.count))
+    for name, func in [('strptime + tz_offset (V2.4)', old), ('utc_to_local (no cache)', uncached), ('utc_to_local (cached)', cached)]:
+        report(name, min(timeit.repeat(func, number=1, repeat=arg.repeat)), arg.count)
+
+def bench_validate(arg):
+    '''
+    schema validation cost for a /configin payload (one hub) and an editor update (all hubs)
+    for each installed validator (fastjsonschema, jsonschema)
+    '''
+    backends = []
+    for name in ['fastjsonschema', 'jsonschema']:
+        try:
+            backends.append((name, __import__(name)))
+        except ImportError:
+            print('validate: {} not installed'.format(name))
+    have_fastjsonschema = vhs.HAVE_FASTJSONSCHEMA
+    hub = sample_hub()
+    settings = sample_settings(arg.hubs)
+    for name, module in backends:
+        vhs.HAVE_FASTJSONSCHEMA = name == 'fastjsonschema'
+        server = object.__new__(vhs.vegehubserver)
+        server.log = vhs.logging.getLogger('benchmark')
+        server.schema_file = vhs.os.path.join(vhs.os.path.dirname(vhs.os.path.abspath(vhs.__file__)), 'vegehub_json_schema.json')
+        server.schema_mtime = None
+        server.serializer = vhs.json_codec()
+        start = time.perf_counter()
+        if not server.get_validators():
+            continue
+        print('validate: schema compiled by {} in {:.1f} ms'.format(name, (time.perf_counter() - start)*1000))
+        assert not server.schema_errors(hub, hub=True), server.schema_errors(hub, hub=True)
+        report('{} /configin (1 hub)'.format(name), min(timeit.repeat(lambda: server.schema_errors(hub, hub=True), number=arg.count, repeat=arg.repeat)), arg.count, 'payload')
+        count = max(1, arg.count // arg.hubs)
+        report('{} /api/updatejson ({} hubs)'.format(name, arg.hubs), min(timeit.repeat(lambda: server.schema_errors(settings), number=count, repeat=arg.repeat)), count, 'payload')
+    vhs.HAVE_FASTJSONSCHEMA = have_fastjsonschema
+
+def allocated(func):
+    '''
+    return (result of func(), bytes allocated by func and still in use)
+    '''
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        result = func()
+        return result, tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+        
+def bench_memory(arg):
+    '''
+    memory used by arg.hubs hub settings and a backlog of arg.count updates, as decoded json (dicts)
+    and as models (vegehubserver2.settings_model and update_model), plus the cost of converting them
+    '''
+    config = json.dumps(sample_settings(arg.hubs))
+    updates = json.dumps(backlog(arg.count, rng=random.Random(1)))
+    settings, dicts = allocated(lambda: json.loads(config))
+    models, compact = allocated(lambda: {mac: vhs.settings_model.from_json(hub) for mac, hub in json.loads(config).items()})
+    assert {mac: hub.to_json() for mac, hub in models.items()} == settings
+    print('memory: {} hubs, {:,} bytes of json'.format(arg.hubs, len(config)))
+    print('{:<40} {:>10,.0f} bytes/hub'.format('settings as dicts', dicts/arg.hubs))
+    print('{:<40} {:>10,.0f} bytes/hub  ({:.0%})'.format('settings as models', compact/arg.hubs, compact/dicts))
+    report('settings_model.from_json', min(timeit.repeat(lambda: [vhs.settings_model.from_json(hub) for hub in settings.values()], number=1, repeat=arg.repeat)), arg.hubs, 'hub')
+    report('settings_model.to_json', min(timeit.repeat(lambda: [hub.to_json() for hub in models.values()], number=1, repeat=arg.repeat)), arg.hubs, 'hub')
+    records, dicts = allocated(lambda: json.loads(updates))
+    models, compact = allocated(lambda: [vhs.update_model.from_json(update) for update in json.loads(updates)])
+    assert [update.to_json() for update in models] == records
+    print('memory: {} updates, {:,} bytes of json'.format(arg.count, len(updates)))
+    print('{:<40} {:>10,.0f} bytes/update'.format('updates as dicts', dicts/arg.count))
+    print('{:<40} {:>10,.0f} bytes/update  ({:.0%})'.format('updates as models', compact/arg.count, compact/dicts))
+    report('update_model.from_json', min(timeit.repeat(lambda: [vhs.update_model.from_json(update) for update in records], number=1, repeat=arg.repeat)), arg.count)
+
+def bench_json(arg):
+    '''
+    compare the installed json libraries (vegehubserver2.json_codec) on the payloads the server handles:
+    decoding updates and /configin, encoding the response to a hub with new settings, and writing config.json
+    settings are encoded as dicts, see the memory benchmark for the cost of converting models (to_json)
+    '''
+    hub = sample_hub()
+    settings = sample_settings(arg.hubs)
+    response = dict(hub, who_updated=2)
+    payloads = [('decode update (1)', 'loads', json.dumps({'key': 'gate', 'updates': backlog(1)}).encode()),
+                ('decode update ({})'.format(arg.count), 'loads', json.dumps({'key': 'gate', 'updates': backlog(arg.count)}).encode()),
+                ('decode /configin', 'loads', json.dumps(hub).encode()),
+                ('encode response with settings', 'encode', response),
+                ('encode config ({} hubs, compact)'.format(arg.hubs), 'encode', settings),
+                ('encode config ({} hubs, pretty)'.format(arg.hubs), 'pretty', settings)]
+    print('json: {}'.format(', '.join('{} {}'.format(name, 'installed' if available else 'not installed') for name, available in vhs.json_codec.BACKENDS.items())))
+    codecs = [vhs.json_codec(name) for name, available in vhs.json_codec.BACKENDS.items() if available]
+    for name, method, payload in payloads:
+        expected = json.loads(payload) if method == 'loads' else json.loads(vhs.json_codec('json').encode(payload))
+        for codec in codecs:
+            func = getattr(codec, method)
+            result = func(payload)
+            assert (result if method == 'loads' else json.loads(result)) == expected, (codec.backend, name)
+            report('{:<6} {}'.format(codec.backend, name), min(timeit.repeat(lambda: func(payload), number=100, repeat=arg.repeat)), 100, 'call')
+
+def bench_load(arg):
+    '''
+    load test gateserver with arg.hubs simulated hubs, for each scenario
+    reports throughput, latency, event loop lag (client and server share the loop) and memory
+    with workers, the server in this process is the coordinator, memory and loop lag do not include the workers
+    '''
+    for scenario in arg.scenarios:
+        r = asyncio.run(run_load(scenario, arg))
+        print('load {}: {} requests, {} updates, {} hubs, concurrency {}{}{}'.format(scenario, r['requests'], r['updates'], arg.hubs, arg.concurrency,
+                                                                                       ', queue {}'.format(arg.queue_size) if arg.queue_size else '',
+                                                                                       ', {} workers'.format(arg.workers) if arg.workers else ''))
+        print('  throughput  {:>10,.0f} requests/s {:>10,.0f} updates/s'.format(r['requests']/r['elapsed'], r['updates']/r['elapsed']))
+        print('  latency     p50 {:>8.2f} ms  p99 {:>8.2f} ms  max {:>8.2f} ms'.format(*[x*1000 for x in (percentile(r['latencies'], 50), percentile(r['latencies'], 99), max(r['latencies']))]))
+        print('  loop lag    p50 {:>8.2f} ms  p99 {:>8.2f} ms  max {:>8.2f} ms'.format(*[x*1000 for x in (percentile(r['lags'], 50), percentile(r['lags'], 99), max(r['lags'], default=0))]))
+        print('  mqtt        {:,} messages published, {:,} dropped ({:,} received by broker in total)'.format(r['mqtt'], r['dropped'], r['received']))
+        print('  memory      {:.1f} MB -> {:.1f} MB'.format(*r['memory']))
+        if r['dropped']:
+            print('  FAIL        {:,} mqtt messages dropped with the broker connected'.format(r['dropped']))
+        if r['errors']:
+            print('  errors      {} {}'.format(len(r['errors']), sorted(set(r['errors']))))
+            
+LOAD_SCENARIOS = ['periodic', 'backlog', 'configin']
+
+BENCHMARKS = {'timestamps': bench_timestamps,
+              'validate': bench_validate,
+              'memory': bench_memory,
+              'json': bench_json,
+              'load': bench_load,
+              'startup': bench_startup}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for Vegehub server')
+    parser.add_argument('benchmarks', nargs='*', action="store", default=list(BENCHMARKS.keys()), help='benchmarks to run {} (default: all)'.format(list(BENCHMARKS.keys())))
+    parser.add_argument('-c','--count', action="store", type=int, default=500, help='number of updates per run (default: %(default)s)')
+    parser.add_argument('-H','--hubs', action="store", type=int, default=10, help='number of hubs (default: %(default)s)')
+    parser.add_argument('-r','--repeat', action="store", type=int, default=5, help='number of runs, best is reported (default: %(default)s)')
+    parser.add_argument('-n','--requests', action="store", type=int, default=500, help='load: number of requests for periodic and configin scenarios (default: %(default)s)')
+    parser.add_argument('-C','--concurrency', action="store", type=int, default=10, help='load: number of concurrent clients (default: %(default)s)')
+    parser.add_argument('-s','--scenarios', action="store", nargs='+', choices=LOAD_SCENARIOS, default=LOAD_SCENARIOS, help='load: scenarios to run (default: %(default)s)')
+    parser.add_argument('-q','--queue_size', action="store", type=int, default=0, help='load: server ingest queue size (default: %(default)s)')
+    parser.add_argument('-w','--workers', action="store", type=int, default=0, help='load: server worker processes (default: %(default)s)')
+    parser.add_argument('-mb','--mqtt_buffer', action="store", type=int, default=10000, help='load: server mqtt buffer size, only used while the broker is disconnected (default: %(default)s)')
+    parser.add_argument('-P','--publish_rate', action="store", type=float, default=5000, help='startup: server config topics published per second, 0 for no limit (default: %(default)s)')
+    parser.add_argument('-S','--seed', action="store", type=int, default=1, help='load: random seed for payloads (default: %(default)s)')
+    parser.add_argument('-V','--version', action='version',version='%(prog)s {version}'.format(version=__VERSION__))
+    arg = parser.parse_args()
+
+    print('Python Version: {}'.format(sys.version.replace('\n','')))
+    print('Vegehub Server Version: {}'.format(vhs.__version__))
+    for benchmark in arg.benchmarks:
+        if benchmark not in BENCHMARKS:
+            print('Unknown benchmark: {}'.format(benchmark))
+            continue
+        BENCHMARKS[benchmark](arg)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,653 @@
+'''
+tests for vegehubserver2.py, run with: python -m pytest tests
+'''
+import argparse, asyncio, copy, json, logging, os
+import pytest
+
+import vegehubserver2 as vhs
+import benchmark     #for sample_hub
+
+HUB = {"api_key": "gate",
+       "mac": "F8F005AD7A0A",
+       "updated": "2025-06-17T13:26:55.000Z",
+       "who_updated": 1,
+       "hub": {"name": "gate", "sample_period": 300, "utc_offset": -14400, "new_setting": {"a": [1, 2]}},
+       "sensors": [{"slot": 0, "mode": 1, "warm_up": 0.9}, {"slot": 1, "mode": 0}],
+       "actuators": [{"name": "relay", "slot": 0, "conditions": [{"sequence": 0, "lower": 1.5, "upper": 3.0}]}],
+       "schedules": [{"name": "water", "idx": 0, "actions": [{"enabled": 1, "actuator_slot": 0, "duration": 10}]}],
+       "web_conditions": [],
+       "schedule_overrides": [],
+       "future_key": "kept"}
+
+
+@pytest.mark.parametrize('cls, obj', [
+    (vhs.settings_model, HUB),
+    (vhs.settings_model, {}),
+    (vhs.hub_model, HUB['hub']),
+    (vhs.update_model, {"created_at": "2025-06-17 13:26:55", "field2": 2.563, "field5": 12.419}),
+    (vhs.update_model, {"created_at": "2025-06-17 13:26:55", "field9": 1}),
+])
+def test_model_round_trip(cls, obj):
+    m = cls.from_json(copy.deepcopy(obj))
+    assert m.to_json() == obj
+    assert list(m.to_json().keys()) == [k for k in cls.FIELDS if k in obj] + [k for k in obj if k not in cls.FIELDS]
+    assert m == cls.from_json(obj)
+
+
+def test_model_mapping():
+    m = vhs.settings_model.from_json(HUB)
+    assert m['hub']['name'] == 'gate'
+    assert m['future_key'] == 'kept'
+    assert m.get('route_key') is None
+    assert 'route_key' not in m and 'mac' in m
+    assert len(m) == len(HUB)
+    assert set(m.keys()) == set(HUB.keys())
+    with pytest.raises(KeyError):
+        m['route_key']
+
+
+@pytest.mark.parametrize('keys, value', [
+    (('hub', 'sample_period'), 900),
+    (('sensors', 1, 'mode'), 2),
+    (('actuators', 0, 'conditions', 0, 'lower'), 0.5),
+    (('hub', 'new_setting', 'a', 0), 5),
+    (('future_key',), 'changed'),
+    (('route_key',), 'route'),
+])
+def test_model_replace(keys, value):
+    m = vhs.settings_model.from_json(HUB)
+    new = m.replace(keys, value)
+    assert new.get_path(keys) == value
+    assert m.to_json() == HUB   #original unchanged
+    expected = copy.deepcopy(HUB)
+    item = expected
+    for key in keys[:-1]:
+        item = item[key]
+    item[keys[-1]] = value
+    assert new.to_json() == expected
+    assert new['schedules'] is m['schedules']   #unchanged objects are shared
+
+
+def bare_server(settings=None):
+    '''
+    return a vegehubserver without starting it, for testing methods that only use settings
+    '''
+    server = object.__new__(vhs.vegehubserver)
+    server.settings = {mac: vhs.settings_model.from_json(hub) for mac, hub in (settings or {}).items()}
+    server.path_index = {}
+    server.validate = False
+    server.serializer = vhs.json_codec()
+    return server
+
+
+@pytest.mark.parametrize('value, current, expected', [
+    ('900', 300, 900),
+    ('-2', 0, -2),
+    ('1.5', 0.9, 1.5),
+    ('2', 0.9, 2),
+    ('1e2', 0.5, 100.0),
+    ('gate', 'name', 'gate'),
+    ('300', 'name', '300'),
+    ('x', None, 'x'),
+    (7, 300, 7),
+    ('0.5', 0, 0.5),        #eg hysteresis, a number stored as 0 (integer settings are checked by the schema)
+    (1.0, 300, 1.0),
+])
+def test_get_value(value, current, expected):
+    result = bare_server().get_value(value, current)
+    assert result == expected and type(result) is type(expected)
+
+
+@pytest.mark.parametrize('value, current', [
+    ('fast', 300),
+    (5, 'name'),
+    (None, 300),
+])
+def test_get_value_invalid(value, current):
+    with pytest.raises(ValueError):
+        bare_server().get_value(value, current)
+
+
+@pytest.mark.parametrize('changes, expected', [
+    ({'hub/sample_period': '900'}, {('hub', 'sample_period'): 900}),
+    ({'hub/sample_period': 60, 'sensors/1/mode': '2', 'actuators/0/name': 'pump'},
+     {('hub', 'sample_period'): 60, ('sensors', 1, 'mode'): 2, ('actuators', 0, 'name'): 'pump'}),
+    ({'schedules/0/actions/0/duration': '20'}, {('schedules', 0, 'actions', 0, 'duration'): 20}),
+])
+def test_update_settings(changes, expected):
+    server = bare_server({HUB['mac']: HUB})
+    settings = server.update_settings(HUB['mac'], changes)
+    for keys, value in expected.items():
+        assert settings.get_path(keys) == value
+    assert server.settings[HUB['mac']].to_json() == HUB  #stored settings are not changed
+
+
+@pytest.mark.parametrize('changes', [
+    {},
+    {'hub/nothere': '1'},
+    {'hub/sample_period': '900', 'sensors/1/mode': 'fast'},    #one invalid value rejects them all
+    {'hub/name': 5},
+])
+def test_update_settings_invalid(changes):
+    with pytest.raises(ValueError):
+        bare_server({HUB['mac']: HUB}).update_settings(HUB['mac'], changes)
+
+
+@pytest.mark.skipif(not vhs.HAVE_JSONSCHEMA, reason='fastjsonschema or jsonschema not installed')
+@pytest.mark.parametrize('changes, valid', [
+    ({'sensors/1/mode': '0'}, True),
+    ({'hub/sample_period': '900.5'}, False),                    #integer in the schema
+    ({'actuators/0/conditions/0/hysteresis': '0.5'}, True),    #number in the schema, stored as 0
+    ({'hub/sample_period': '120'}, False),                      #out of range
+])
+def test_update_settings_validated(changes, valid):
+    hub = benchmark.sample_hub()
+    hub['actuators'][0]['conditions'][0]['hysteresis'] = 0
+    server = bare_server({hub['mac']: hub})
+    server.validate = True
+    server.log = vhs.logging.getLogger('test')
+    server.schema_file = vhs.os.path.join(vhs.BASE_DIR, 'vegehub_json_schema.json')
+    server.schema_mtime = None
+    server.validators = None
+    if valid:
+        server.update_settings(hub['mac'], changes)
+    else:
+        with pytest.raises(ValueError):
+            server.update_settings(hub['mac'], changes)
+
+
+@pytest.mark.parametrize('target, payload, changes', [
+    (['hub', 'sample_period'], '900', {'hub/sample_period': '900'}),
+    (['hub'], '{"sample_period": 900, "name": "x"}', {'hub/sample_period': 900, 'hub/name': 'x'}),
+    ([], '{"hub/name": "x"}', {'hub/name': 'x'}),
+    (['hub', 'name'], '{"a": 1}', {'hub/name': '{"a": 1}'}),     #a value in the settings, so not a batch
+    (['hub'], '{bad', {'hub': '{bad'}),
+])
+def test_mqtt_changes(target, payload, changes):
+    assert bare_server({HUB['mac']: HUB}).mqtt_changes(HUB['mac'], target, payload) == changes
+
+
+@pytest.mark.parametrize('key, label', [
+    ('gate', HUB['mac']),
+    (HUB['mac'], HUB['mac']),
+    ('junk', 'unknown'),
+    ('192.168.100.99', 'unknown'),
+    (None, 'unknown'),
+])
+def test_hub_label(key, label):
+    server = bare_server({HUB['mac']: HUB})
+    server.build_index()
+    assert server.hub_label(key) == label
+
+
+JUNE = 1750000000.0     #2025-06-15
+JULY = 1752000000.0     #2025-07-08
+
+
+@pytest.fixture
+def history(tmp_path):
+    store = vhs.timeseries(str(tmp_path))
+    store.append('gate', 'field4', [(JUNE + i * 60, float(i)) for i in range(10)])
+    store.append('gate', 'field4', [(JULY + i * 60, float(100 + i)) for i in range(10)])
+    return store
+
+
+@pytest.mark.parametrize('start, end, step, timestamps, values', [
+    (None, None, None, [JUNE + i * 60 for i in range(10)] + [JULY + i * 60 for i in range(10)], [float(i) for i in range(10)] + [float(100 + i) for i in range(10)]),
+    (JUNE + 120, JUNE + 240, None, [JUNE + 120, JUNE + 180, JUNE + 240], [2.0, 3.0, 4.0]),
+    (JUNE + 119, JUNE + 121, None, [JUNE + 120], [2.0]),
+    (JULY + 540, None, None, [JULY + 540], [109.0]),
+    (JUNE + 600, JULY - 1, None, [], []),
+    (JUNE, JUNE + 539, 300, [JUNE - JUNE % 300, JUNE - JUNE % 300 + 300], [sum(range(4)) / 4, sum(range(4, 9)) / 5]),     #buckets start 100s before JUNE
+    (JULY + 1000, None, None, [], []),
+])
+def test_timeseries_query(history, start, end, step, timestamps, values):
+    assert history.query('gate', 'field4', start, end, step) == (timestamps, values)
+
+
+def test_timeseries_append(history, tmp_path):
+    assert history.append('gate', 'field4', [(JUNE, 1.0), (JULY + 540, 5.0), (JULY + 600, 6.0)]) == 2    #older records are skipped
+    assert history.query('gate', 'field4', JULY + 540) == ([JULY + 540, JULY + 540, JULY + 600], [109.0, 5.0, 6.0])
+    assert history.segments('gate', 'field4') == ['202506', '202507']
+    assert vhs.timeseries(str(tmp_path)).get_last_ts('gate', 'field4') == JULY + 600    #read from the store
+    assert history.query('gate', 'field5') == ([], [])
+    assert history.query('nothere', 'field4') == ([], [])
+
+
+DOC = {"a": {"b": 1, "c": [1, 2, 3]}, "x/y": 1, "m~n": 2, "l": [{"v": 1}, {"v": 2}]}
+
+
+@pytest.mark.parametrize('patch, expected', [
+    ([], DOC),
+    ([{"op": "add", "path": "/a/d", "value": 4}], dict(DOC, a={"b": 1, "c": [1, 2, 3], "d": 4})),
+    ([{"op": "add", "path": "/a/b", "value": 5}], dict(DOC, a={"b": 5, "c": [1, 2, 3]})),
+    ([{"op": "add", "path": "/a/c/0", "value": 0}], dict(DOC, a={"b": 1, "c": [0, 1, 2, 3]})),
+    ([{"op": "add", "path": "/a/c/3", "value": 4}], dict(DOC, a={"b": 1, "c": [1, 2, 3, 4]})),
+    ([{"op": "add", "path": "/a/c/-", "value": 4}], dict(DOC, a={"b": 1, "c": [1, 2, 3, 4]})),
+    ([{"op": "remove", "path": "/a/b"}], dict(DOC, a={"c": [1, 2, 3]})),
+    ([{"op": "remove", "path": "/a/c/1"}], dict(DOC, a={"b": 1, "c": [1, 3]})),
+    ([{"op": "replace", "path": "/a/c/1", "value": 9}], dict(DOC, a={"b": 1, "c": [1, 9, 3]})),
+    ([{"op": "replace", "path": "/l/1/v", "value": 9}], dict(DOC, l=[{"v": 1}, {"v": 9}])),
+    ([{"op": "replace", "path": "/x~1y", "value": 9}], dict(DOC, **{"x/y": 9})),
+    ([{"op": "replace", "path": "/m~0n", "value": 9}], dict(DOC, **{"m~n": 9})),
+    ([{"op": "move", "from": "/a/b", "path": "/z"}], dict(DOC, a={"c": [1, 2, 3]}, z=1)),
+    ([{"op": "move", "from": "/a/c/0", "path": "/a/c/-"}], dict(DOC, a={"b": 1, "c": [2, 3, 1]})),
+    ([{"op": "move", "from": "/a/b", "path": "/a/b"}], DOC),
+    ([{"op": "copy", "from": "/l/0", "path": "/l/-"}], dict(DOC, l=[{"v": 1}, {"v": 2}, {"v": 1}])),
+    ([{"op": "copy", "from": "/a/c", "path": "/c"}, {"op": "add", "path": "/c/-", "value": 4}], dict(DOC, c=[1, 2, 3, 4])),   #copies are not shared
+    ([{"op": "test", "path": "/a/c", "value": [1, 2, 3]}, {"op": "test", "path": "/x~1y", "value": 1}], DOC),
+    ([{"op": "test", "path": "", "value": DOC}], DOC),
+    ([{"op": "remove", "path": "/a/c/0"}, {"op": "test", "path": "/a/c/0", "value": 2}], dict(DOC, a={"b": 1, "c": [2, 3]})),
+])
+def test_apply_patch(patch, expected):
+    doc = copy.deepcopy(DOC)
+    assert bare_server().apply_patch(doc, patch) == expected
+    assert doc == DOC   #the original is not changed
+
+
+@pytest.mark.parametrize('patch', [
+    {"op": "add", "path": "/a/d", "value": 4},                      #not a list
+    [{"op": "add", "path": "/a/d"}],                                #no value
+    [{"path": "/a/b"}],                                             #no op
+    [{"op": "frobnicate", "path": "/a/b"}],
+    [{"op": "add", "path": "a/d", "value": 4}],                     #not a pointer
+    [{"op": "add", "path": "", "value": 4}],                        #whole document
+    [{"op": "add", "path": "/a/c/4", "value": 4}],                  #out of range
+    [{"op": "add", "path": "/a/c/01", "value": 4}],                 #leading zero
+    [{"op": "add", "path": "/a/c/x", "value": 4}],
+    [{"op": "add", "path": "/nothere/d", "value": 4}],
+    [{"op": "add", "path": "/a/b/d", "value": 4}],                  #b is not a container
+    [{"op": "remove", "path": "/a/nothere"}],
+    [{"op": "remove", "path": "/a/c/3"}],
+    [{"op": "remove", "path": "/a/c/-"}],
+    [{"op": "replace", "path": "/a/nothere", "value": 4}],
+    [{"op": "replace", "path": "/a/c/3", "value": 4}],
+    [{"op": "move", "from": "/a", "path": "/a/d"}],                 #into itself
+    [{"op": "move", "from": "/a/nothere", "path": "/z"}],
+    [{"op": "move", "path": "/z"}],
+    [{"op": "copy", "from": "/a/nothere", "path": "/z"}],
+    [{"op": "test", "path": "/a/b", "value": 2}],
+    [{"op": "test", "path": "/a/nothere", "value": 1}],
+    [{"op": "replace", "path": "/a/b", "value": 9}, {"op": "test", "path": "/a/b", "value": 1}],   #whole patch fails
+])
+def test_apply_patch_invalid(patch):
+    doc = copy.deepcopy(DOC)
+    with pytest.raises(ValueError):
+        bare_server().apply_patch(doc, patch)
+    assert doc == DOC
+
+
+class chunked_stream():
+    '''
+    stands in for request.content, read returns at most size bytes at a time
+    '''
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+        
+    async def read(self, n=-1):
+        chunk, self.data = self.data[:min(n, self.size)], self.data[min(n, self.size):]
+        return chunk
+
+
+def stream_json(data, size):
+    header = {}
+    async def run():
+        return [item async for item in bare_server().stream_json(chunked_stream(data, size), header, 'updates')]
+    return asyncio.run(run()), header
+
+
+STREAMS = [
+    '{"key": "gate", "updates": [{"created_at": "2025-06-17 13:26:55", "field2": 2.563, "field5": 12.419}, {"created_at": "2025-06-17 13:27:55", "field2": -0.082}]}',
+    '{"updates": [1, 22, 333, -4.5e-3, 1E+10, 0], "channel_id": 12345}',
+    '{"updates": [], "key": "gate"}',
+    '{"key": "gate"}',
+    '{}',
+    '{"updates": [{"a": [1, {"b": "]},"}], "c": null}, true, false, null, "x"]}',
+    r'{"key": "g\"a\\te", "name": "café ☺", "updates": [{"note": "é☺😀 é☺😀 \/\n"}]}',
+    ' \n\t{ "key" : "gate" , "updates" : [ 1 , 2 ] , "n" : 3 } ',
+]
+
+
+@pytest.mark.parametrize('size', [1, 2, 7, 65536])
+@pytest.mark.parametrize('data', STREAMS)
+def test_stream_json(data, size):
+    expected = json.loads(data)
+    items, header = stream_json(data.encode(), size)
+    assert items == expected.pop('updates', [])
+    assert header == expected
+
+
+@pytest.mark.parametrize('size', [1, 3, 65536])
+def test_stream_json_multibyte(size):
+    data = json.dumps({"name": "café ☺ 😀", "updates": ["éé"]}, ensure_ascii=False).encode()     #characters split across reads
+    assert stream_json(data, size) == (["éé"], {"name": "café ☺ 😀"})
+
+
+@pytest.mark.parametrize('size', [1, 65536])
+@pytest.mark.parametrize('data', [
+    b'',
+    b'{"key": ',
+    b'{"key": "gate", "updates": [1, 2',
+    b'{"key": "gate", "updates": [1, 2]',
+    b'{"updates": [{"a": 1}',
+    b'{"key": "ga',
+    b'{"key": 12',
+    b'[1, 2]',
+    b'"gate"',
+    b'{"key" "gate"}',
+    b'{"key": "gate" "n": 1}',
+    b'{"updates": [1 2]}',
+    b'{"updates": [1,, 2]}',
+    b'{"updates": [, 1]}',
+    b'{"updates": [1, ]}',
+    b'{, "key": "gate"}',
+    b'{"key": "gate",, "n": 1}',
+    b'{"key": "gate", }',
+    b'{"updates": [1] "key": 1}',
+    b'{12: 1}',
+    b'{"key": tru}',
+    b'{"updates": [1.2.3]}',
+    b'{"key": "\xff"}',
+    b'{"updates": [{}]} trailing',
+    b'{} {}',
+])
+def test_stream_json_invalid(data, size):
+    with pytest.raises(ValueError):
+        stream_json(data, size)
+
+
+@pytest.mark.parametrize('data, expected', [
+    ({"updates": list(range(250)), "key": "gate"}, [('gate', 250)]),          #held until the key arrives
+    ({"key": "gate", "updates": list(range(250))}, [('gate', 100), ('gate', 100), ('gate', 50)]),
+    ({"updates": list(range(250)), "channel_id": 1}, [(None, 250)]),
+    ({"updates": list(range(150))}, [(None, 150)]),
+    ({"key": "gate"}, [('gate', 0)]),
+])
+def test_stream_update(data, expected):
+    server = bare_server()
+    server.log = vhs.logging.getLogger('test')
+    server.metrics = server.setup_metrics()
+    server.hub_index = {}
+    server.remote_host = '127.0.0.1'
+    received = []
+    async def ingest_update(post_json):
+        received.append((post_json.get('key'), len(post_json.get('updates', ()))))
+    server.ingest_update = ingest_update
+    request = type('request', (), {'content': chunked_stream(json.dumps(data).encode(), 10)})
+    header = asyncio.run(server.stream_update(request))
+    assert 'updates' not in header
+    assert received == expected
+
+
+def update(created_at, value=1.0):
+    return {"created_at": created_at, "field4": value}
+
+
+@pytest.mark.parametrize('size, watermarks, batches, kept', [
+    (10, None, [[update('2025-06-15 10:00:00'), update('2025-06-15 10:01:00')]], [2]),
+    (10, None, [[update('2025-06-15 10:00:00')], [update('2025-06-15 10:00:00')]], [1, 0]),                #resent
+    (10, None, [[update('2025-06-15 10:00:00'), update('2025-06-15 10:00:00')]], [1]),                     #duplicate in one post
+    (10, None, [[update('2025-06-15 10:00:00', 1.0), update('2025-06-15 10:00:00', 2.0)]], [2]),           #same time, different values
+    (10, None, [[update('2025-06-15 10:01:00')], [update('2025-06-15 10:00:00')]], [1, 0]),                #older than the watermark
+    (1, None, [[update('2025-06-15 10:00:00', 1.0), update('2025-06-15 10:00:00', 2.0)], [update('2025-06-15 10:00:00', 1.0)]], [2, 1]),   #fingerprint forgotten
+    (10, None, [[{"field4": 1.0}], [{"field4": 1.0}]], [1, 1]),                                             #no created_at
+    (10, {'gate': 1749981600.0}, [[update('2025-06-15 10:00:00'), update('2025-06-15 10:00:01')]], [1]),  #at the restored watermark
+    (10, {'gate': 1749981600.0}, [[update('2025-06-15 10:00:01')], [update('2025-06-15 10:00:01', 2.0)]], [1, 1]),    #watermark moved
+    (10, {'other': 1749981601.0}, [[update('2025-06-15 10:00:00')]], [1]),
+    (10, None, [[update('2099-01-01 00:00:00')], [update('2025-06-15 10:00:00')], [update('2099-01-01 00:00:00')]], [1, 1, 0]),  #hub clock error
+    (10, {'gate': 4070908800.0}, [[update('2025-06-15 10:00:00')]], [1]),     #future watermark saved before MAX_AHEAD
+])
+def test_replay_filter(size, watermarks, batches, kept):
+    replays = vhs.replay_filter(size, watermarks)
+    for batch, count in zip(batches, kept):
+        new, dropped = replays.filter('gate', batch)
+        assert (len(new), dropped) == (count, len(batch) - count)
+
+
+def test_replay_filter_watermark():
+    replays = vhs.replay_filter(10)
+    replays.filter('gate', [update('2025-06-15 10:01:00'), update('2025-06-15 10:00:00'), {"field4": 1.0}])
+    assert replays.watermarks == {'gate': 1749981660.0}
+    assert replays.advance('gate', 1749981600.0) is False
+    assert replays.advance('gate', 1749981700.0) is True
+    replays.filter('gate', [update('2099-01-01 00:00:00')])
+    assert replays.watermarks == {'gate': 1749981700.0}
+
+
+class fake_client():
+    '''
+    stands in for the paho client, publish fails while not connected
+    '''
+    def __init__(self, connected=True):
+        self.connected = connected
+        self.published = []
+        
+    def publish(self, topic, msg):
+        if not self.connected:
+            return type('result', (), {'rc': vhs.paho.MQTT_ERR_NO_CONN})
+        self.published.append((topic, msg))
+        return type('result', (), {'rc': vhs.paho.MQTT_ERR_SUCCESS})
+        
+    def is_connected(self):
+        return self.connected
+        
+    def disconnect(self):
+        self.connected = False
+        
+    def loop_stop(self):
+        pass
+
+
+def mqtt_server(tmp_path, connected=True, size=3, spool=True):
+    '''
+    return a vegehubserver (not started) using a fake_client, must be called on the event loop
+    '''
+    arg = argparse.Namespace(config=str(tmp_path / 'config.json'), mqtt_buffer=size, mqtt_batch=2,
+                                 mqtt_spool=str(tmp_path / 'spool.json') if spool else None)
+    server = vhs.vegehubserver(arg=arg, log=logging.getLogger('test'))
+    server.startup_task.cancel()
+    server.mqttc = fake_client(connected)
+    server.mqtt_connected = connected
+    server.brokerFeedback = '/s/'
+    return server
+
+
+def messages(count, start=0):
+    return [('topic{}'.format(i), str(i)) for i in range(start, start + count)]
+
+
+def spooled(server):
+    with open(server.mqtt_spool, encoding='utf-8') as f:
+        return [tuple(json.loads(line)) for line in f]
+
+
+@pytest.mark.parametrize('connected, spool, published, buffer, spool_file, dropped', [
+    (True, True, messages(5), [], None, 0),                       #published as queued
+    (False, False, [], messages(3, 2), None, 2),                  #oldest dropped
+    (False, True, [], messages(3), messages(2, 3), 0),            #spooled when the buffer is full
+])
+def test_queue_message(tmp_path, connected, spool, published, buffer, spool_file, dropped):
+    async def run():
+        server = mqtt_server(tmp_path, connected, spool=spool)
+        for topic, msg in messages(5):
+            server.queue_message(topic, msg)
+        assert server.mqttc.published == published
+        assert list(server.mqtt_buffer) == buffer
+        assert server.mqtt_stats['dropped'] == dropped
+        assert server.mqtt_stats['spooled'] == len(spool_file or ())
+        if spool_file:
+            assert spooled(server) == spool_file
+    asyncio.run(run())
+
+
+def test_queue_message_spooled(tmp_path):
+    async def run():
+        server = mqtt_server(tmp_path, connected=False)
+        for topic, msg in messages(4):
+            server.queue_message(topic, msg)
+        server.mqttc.connected = server.mqtt_connected = True
+        server.queue_message('topic4', '4')      #after spooled messages, not published first
+        assert server.mqttc.published == []
+        assert spooled(server) == messages(2, 3)
+    asyncio.run(run())
+
+
+def test_load_spool(tmp_path):
+    async def run():
+        server = mqtt_server(tmp_path, connected=False, size=2)
+        for topic, msg in messages(7):
+            server.queue_message(topic, msg)
+        server.mqtt_buffer.clear()
+        server.load_spool()
+        assert list(server.mqtt_buffer) == messages(2, 2)
+        assert server.mqtt_stats['spooled'] == 3
+        server.mqtt_buffer.clear()
+        server.load_spool()
+        server.mqtt_buffer.popleft()
+        server.load_spool()
+        assert list(server.mqtt_buffer) == messages(2, 5)
+        assert server.mqtt_stats['spooled'] == 0
+        assert not os.path.exists(server.mqtt_spool)   #removed when all are loaded
+    asyncio.run(run())
+
+
+def test_mqtt_publisher(tmp_path):
+    async def run():
+        server = mqtt_server(tmp_path, connected=False, size=2)
+        for topic, msg in messages(7):
+            server.queue_message(topic, msg)
+        task = asyncio.create_task(server.mqtt_publisher())
+        server.mqttc.connected = server.mqtt_connected = True
+        server.wake_publisher()
+        for i in range(100):
+            await asyncio.sleep(0)
+        task.cancel()
+        assert server.mqttc.published == messages(7)
+        assert server.mqtt_stats == {'published': 7, 'dropped': 0, 'spooled': 0}
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('loaded, spool, spool_file, dropped', [
+    (0, True, messages(3) + messages(4, 3), 0),     #buffer, then messages already spooled
+    (1, True, messages(3, 4), 0),                   #buffer holds spooled messages, the rest are not loaded yet
+    (0, False, None, 7),                            #4 dropped when queued, 3 at shutdown
+])
+def test_cancel(tmp_path, loaded, spool, spool_file, dropped):
+    async def run():
+        server = mqtt_server(tmp_path, connected=False, spool=spool)
+        for topic, msg in messages(7):
+            server.queue_message(topic, msg)
+        if loaded:
+            server.mqtt_buffer.clear()
+            server.load_spool()
+            server.mqtt_buffer.popleft()
+        await server.cancel()
+        assert server.mqtt_stats['dropped'] == dropped
+        if spool_file:
+            assert not server.mqtt_buffer
+            assert spooled(server) == spool_file
+            assert server.mqtt_stats['spooled'] == len(spool_file)
+    asyncio.run(run())
+
+
+TOPICS = {'A': {'hub': {'name': 'a', 'sample_period': 300}}, 'B': {'hub': {'name': 'b'}}}
+
+
+@pytest.mark.parametrize('settings, full, partial, published', [
+    (TOPICS, False, False, {}),     #unchanged
+    ({'A': {'hub': {'name': 'x', 'sample_period': 300}}, 'B': TOPICS['B']}, False, False, {'A_hub_name': False, 'A_hub': False, 'A': False}),
+    ({'A': {'hub': {'name': 'a'}}, 'B': TOPICS['B']}, False, False, {'A_hub': False, 'A': False, 'A_hub_sample_period': True}),     #removed leaf
+    ({'A': TOPICS['A']}, False, False, {'B_hub_name': True, 'B_hub': True, 'B': True}),     #removed hub
+    ({'A': TOPICS['A']}, True, True, {'A_hub_name': False, 'A_hub_sample_period': False, 'A_hub': False, 'A': False}),
+    ({'A': {'hub': {'name': 'x', 'sample_period': 300}}}, False, True, {'A_hub_name': False, 'A_hub': False, 'A': False}),     #B is kept
+])
+def test_decode_topics(tmp_path, settings, full, partial, published):
+    '''
+    published is {topic: removed} for the topics published after TOPICS were
+    '''
+    async def run():
+        server = mqtt_server(tmp_path)
+        assert server.decode_topics(TOPICS) == 7
+        server.mqttc.published.clear()
+        assert server.decode_topics(settings, full=full, partial=partial) == sum(1 for removed in published.values() if not removed)
+        assert {topic[len('/s/'):]: msg == '' for topic, msg in server.mqttc.published} == published
+        assert server.topic_stats['removed'] == sum(published.values())
+        assert set(server.published_topics) == set(settings) | ({'B'} if partial else set())
+    asyncio.run(run())
+
+
+def test_decode_topics_no_broker(tmp_path):
+    async def run():
+        server = mqtt_server(tmp_path)
+        server.mqttc = None
+        assert server.decode_topics(TOPICS) == 0
+        assert server.topic_stats['published'] == 0
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('dropped, published', [
+    (0, 0),     #nothing lost while disconnected
+    (1, 7),     #all topics published again
+])
+def test_broker_connected(tmp_path, dropped, published):
+    async def run():
+        server = mqtt_server(tmp_path)
+        server.settings = {mac: vhs.settings_model.from_json(hub) for mac, hub in TOPICS.items()}
+        server.decode_topics(server.settings)
+        server.mqttc.published.clear()
+        server.mqtt_stats['dropped'] = dropped
+        server.broker_connected()
+        if server.publish_task:
+            await server.publish_task
+        assert len(server.mqttc.published) == published
+        server.broker_connected()   #only once for the same messages dropped
+        assert not server.publish_task or server.publish_task.done()
+    asyncio.run(run())
+
+
+def bare_gateserver(IR_offset=0.67):
+    server = object.__new__(vhs.gateserver)
+    server.log = logging.getLogger('test')
+    server.serializer = vhs.json_codec()
+    server.IR_offset = IR_offset
+    return server
+
+
+@pytest.mark.parametrize('IR_offset, channel, levels', [
+    (0.67, {'type': 'light', 'name': 'light'}, [[3.1, 'Very Bright'], [2.7, 'Bright'], [1.17, 'Daylight'], [0.67, 'Dusk']]),
+    (0.9, {'type': 'light', 'name': 'light'}, [[3.1, 'Very Bright'], [2.7, 'Bright'], [1.17, 'Daylight'], [0.9, 'Dusk']]),
+    (0.9, {'type': 'light', 'name': 'light', 'levels': [[1, 'Day'], [2, 'Sun']]}, [[2, 'Sun'], [1, 'Day']]),
+])
+def test_compile_channels_light(IR_offset, channel, levels):
+    gate, readings = bare_gateserver(IR_offset).compile_channels({'field4': channel})
+    assert readings[0][2]['levels'] == levels
+    assert vhs.gateserver.CHANNEL_TYPES['light']['levels'][-1][1] != 'Dusk'     #defaults are not changed
+
+
+@pytest.mark.parametrize('channels, fields', [
+    ({'field1': {'type': 'gate', 'name': 'door'}, 'field4': {'type': 'value', 'name': 'temp', 'scale': 2}}, ['field1', 'field4']),
+    ({'field4': {'type': 'value', 'name': 'temp', 'field': 'field9'}}, ['field4']),    #field is the key of the map
+    ({'field4': {'type': 'bogus', 'name': 'temp'}}, []),
+    ({'field4': {'type': 'value'}}, []),
+    ({'field4': 'value'}, []),
+])
+def test_compile_channels(channels, fields):
+    gate, readings = bare_gateserver().compile_channels(channels)
+    assert [c['field'] for c in gate] + [c['field'] for field, decoder, c in readings] == fields
+    assert all(field == c['field'] for field, decoder, c in readings)
+
+
+@pytest.mark.parametrize('content, hubs', [
+    (None, ['default']),        #missing file
+    ('{"gate": {"field4": {"type": "value", "name": "temp"}}}', ['default', 'gate']),
+    ('{"gate": ', ['default']),
+    ('["gate"]', ['default']),
+    ('{"gate": 1}', ['default']),
+])
+def test_load_channels(tmp_path, caplog, content, hubs):
+    filename = tmp_path / 'channels.json'
+    if content is not None:
+        filename.write_text(content)
+    assert list(bare_gateserver().load_channels(str(filename))) == hubs
+    assert ('Could not load channel maps' in caplog.text) == (len(hubs) == 1)
@@ -14,28 +14,58 @@
 # N Waterton 23rd feb 2023 V2.3: remove depreciated asyncio.get_event_loop()
 # N Waterton 17th June 2025 V2.4: Rework some processing logic and replace failed vegehub. Update to Python 3.10 and above
 
+import time
+START_TIME = time.perf_counter()    #for time to first accept in the startup log
 import logging
 from logging.handlers import RotatingFileHandler
+import importlib, importlib.util
+#optional modules are imported when first used (see lazy_module), as they slow down startup
 global HAVE_MQTT
-HAVE_MQTT = False
-try:
-    import paho.mqtt.client as paho
-    HAVE_MQTT = True
-except ImportError:
+HAVE_MQTT = importlib.util.find_spec('paho') is not None
+if not HAVE_MQTT:
     print("paho mqtt client not found")
-import os, sys, json, math
+global HAVE_FASTJSONSCHEMA
+HAVE_FASTJSONSCHEMA = importlib.util.find_spec('fastjsonschema') is not None
+global HAVE_JSONSCHEMA
+HAVE_JSONSCHEMA = HAVE_FASTJSONSCHEMA or importlib.util.find_spec('jsonschema') is not None
+global HAVE_BROTLI
+HAVE_BROTLI = importlib.util.find_spec('brotli') is not None
+global HAVE_ORJSON
+HAVE_ORJSON = importlib.util.find_spec('orjson') is not None
+global HAVE_UJSON
+HAVE_UJSON = importlib.util.find_spec('ujson') is not None
+global HAVE_NUMPY
+HAVE_NUMPY = importlib.util.find_spec('numpy') is not None
+import os, sys, json, math, re, codecs
+import copy, hashlib, gzip
+import traceback
+import tempfile, shutil
+import struct, mmap
+from bisect import bisect_left
 import socket
 import signal
+import threading
+from collections import deque
 import datetime as dt
 from enum import Enum
+from functools import lru_cache
 import asyncio
 from aiohttp import web
 
 __VERSION__ = __version__ = '2.4'
 
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))   #static files are served from here
+
 class vegehubserver():
 
     __VERSION__ = __version__ = __VERSION__
+    
+    STREAM_CHUNK = 100  #number of updates to process at a time when streaming
+    JSON_WS = re.compile(r'[ \t\n\r]*')
+    JSON_NUMBER = re.compile(r'[0-9.eE+-]*')
+    NUMBER = re.compile(r'-?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?')
+    NO_SETTINGS_RESPONSE = ({'who_updated' : 0}, json.dumps({'who_updated' : 0}).encode())
+    ASSETS = {'index.html': 'text/html', 'spec.json': 'text/plain', 'vegehub_json_schema.json': 'text/plain'}   #static files and content types
 
     def __init__(self, webport=None, log=None, arg=None):
         self.log = log if log else logging.getLogger("Vegehub.api")
@@ -43,19 +73,112 @@ class vegehubserver():
         if not isinstance(self.webport, list):
             self.webport = [self.webport]
         self.config_file = arg.config if arg else 'config.json'
-        self.settings = self.load_settings()
+        self.serializer = json_codec(getattr(arg, 'json', None))
+        self.compact_config = getattr(arg, 'compact_config', False) #write config file without indents
+        self.log.info('Using %s for json', self.serializer.backend)
+        self.hub_index = {}     #api_key, id, mac, current_ip_addr, name -> mac
+        self.hub_index_keys = {}    #mac -> keys indexed for that mac
+        self.response_cache = {}    #mac -> (response, encoded response) for hub data updates
+        self.hub_cache = {}         #mac -> (etag, encoded settings) for the editor api
+        self.path_index = {}        #mac -> {path: keys} for settings from the broker
+        self.settings = {}          #loaded by startup() after the web port(s) are listening
+        self.settings_loaded = asyncio.Event()
         self.app = None
-        self.web_task = []#None
+        self.runner = None
         self.mqttc = None
         self.remote_host = None
         self.arg = arg
-        if self.arg:
+        self.write_delay = getattr(arg, 'write_delay', 2.0)   #seconds to coalesce config file writes over
+        self.settings_dirty = False
+        self.write_task = None
+        self.write_future = None
+        self.published_topics = {}  #mac: {topic: value} last published by decode_topics
+        self.topics_dropped = 0     #mqtt_stats['dropped'] when config topics were last all published
+        self.publish_rate = getattr(arg, 'publish_rate', 5000)  #initial config topics published per second, 0 for no limit
+        self.publish_task = None
+        self.topic_stats = {'published': 0, 'suppressed': 0, 'removed': 0}
+        self.queue_size = getattr(arg, 'queue_size', 0)     #0 = process updates before responding to hub
+        self.queue_workers = getattr(arg, 'queue_workers', 1)
+        self.queue_block = getattr(arg, 'queue_block', False)   #wait for queue space instead of returning 503
+        self.ingest_queue = None
+        self.ingest_tasks = []
+        self.stream_size = getattr(arg, 'stream_size', 0)   #stream updates larger than this (bytes), 0 to disable
+        self.ingest_stats = {'enqueued': 0, 'processed': 0, 'rejected': 0, 'max_depth': 0, 'duplicates': 0}
+        self.watermark_file = '{}-watermarks.json'.format(os.path.splitext(self.config_file)[0])
+        self.replays = replay_filter(arg.dedupe, self.load_watermarks()) if getattr(arg, 'dedupe', 0) else None
+        self.watermarks_dirty = False
+        self.watermark_task = None
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.mqtt_buffer_size = getattr(arg, 'mqtt_buffer', 10000)  #messages held while broker is unavailable
+        self.mqtt_batch = getattr(arg, 'mqtt_batch', 100)
+        self.mqtt_spool = getattr(arg, 'mqtt_spool', None)    #file to spill messages to when buffer is full
+        self.mqtt_buffer = deque()
+        self.mqtt_connected = False
+        self.mqtt_wakeup = asyncio.Event()
+        self.mqtt_task = None
+        self.mqtt_connect_task = None
+        self.spool_offset = 0
+        self.mqtt_stats = {'published': 0, 'dropped': 0, 'spooled': 0}
+        self.history = timeseries(arg.history, self.log) if getattr(arg, 'history', None) else None
+        self.history_pending = {}   #(hub, field): [(timestamp, value),...] waiting to be stored
+        self.history_task = None
+        self.schema_file = os.path.join(BASE_DIR, 'vegehub_json_schema.json')
+        self.assets = {}    #static file name -> (mtime, etag, {encoding: body})
+        self.validate = getattr(arg, 'validate', False)   #validate configurations against schema_file
+        self.validators = None
+        self.schema_mtime = None
+        if self.validate and not HAVE_JSONSCHEMA:
+            self.log.warning('fastjsonschema or jsonschema not found, configurations will not be validated')
+        self.metrics = self.setup_metrics()
+        self.diagnostics = diagnostics(getattr(arg, 'diagnostics', 0), self.log, self.metrics) if getattr(arg, 'diagnostics', 0) else None
+        self.workers = getattr(arg, 'workers', 0)   #number of worker processes to serve the web port(s), 0 serves them in this process
+        self.coordinator = None
+        self.worker = worker_link(self, arg.worker_socket) if getattr(arg, 'worker_socket', None) else None
+        if self.worker:
+            self.brokerFeedback = arg.pub_topic     #MQTT messages are published by the coordinator
+        self.startup_task = asyncio.create_task(self.startup())
+        
+    async def startup(self):
+        '''
+        start serving the web port(s) first, so hubs that report right after a restart are not refused,
+        then load settings (requests wait for them), connect to the MQTT broker and publish the config
+        topics in the background
+        in a worker process settings are sent by the coordinator
+        '''
+        arg = self.arg
+        if self.workers > 0 and not self.worker:
+            self.coordinator = coordinator(self, self.workers)
+        else:
+            self.start_ingest()
+            await self.start_web()
+        if self.worker:
+            return
+        start = time.perf_counter()
+        self.settings = await self.loop.run_in_executor(None, lambda: self.compact_settings(self.load_settings()))
+        self.build_index()
+        self.settings_loaded.set()
+        self.log.info('Loaded settings for {} hubs in {:.3f}s'.format(len(self.settings), time.perf_counter() - start))
+        if arg:
             try:
                 self.mqttc = self.setup_mqtt_client(arg.broker, arg.port, arg.user, arg.password, arg.pub_topic, arg.sub_topic)
             except Exception as e:
                 self.log.exception(e)
-        self.decode_topics(self.settings)
-        self.start_web()
+        self.publish_task = asyncio.create_task(self.publish_settings())
+        
+    async def publish_settings(self):
+        '''
+        publish the config topics of each hub, limited to publish_rate topics per second
+        so that a large config does not hold up the event loop or fill the MQTT buffer
+        '''
+        start = time.perf_counter()
+        rate = self.publish_rate if self.mqttc else 0
+        published = 0
+        for mac in list(self.settings.keys()):
+            if mac in self.settings:
+                published += self.decode_topics({mac: self.settings[mac]}, partial=True)
+            await asyncio.sleep(max(0, published / rate - (time.perf_counter() - start)) if rate > 0 else 0)
+        self.log.info('Published {} config topics in {:.3f}s'.format(published, time.perf_counter() - start))
             
     def setup_mqtt_client(self, broker=None,
                                  port=1883,
@@ -68,94 +191,211 @@ class vegehubserver():
         '''
         if not broker:
             return None
-        try:
-            # connect to broker
-            self.mqttc = paho.Client()
-            # Assign event callbacks
-            self.mqttc.on_connect = self.broker_on_connect
-            self.mqttc.on_disconnect = self.broker_on_disconnect
-            self.mqttc.on_message = self.broker_on_message
-            if user and passwd:
-                self.mqttc.username_pw_set(user, passwd)
-            self.brokerFeedback = brokerFeedback
-            self.brokerSetting = brokerSetting
-            self.mqttc.connect(broker, port, 60)
-            self.mqttc.loop_start()
-        except socket.error:
-            self.log.error("Unable to connect to MQTT Broker")
-            self.mqttc = None
+        # connect to broker
+        self.mqttc = paho.Client()
+        # Assign event callbacks
+        self.mqttc.on_connect = self.broker_on_connect
+        self.mqttc.on_disconnect = self.broker_on_disconnect
+        self.mqttc.on_message = self.broker_on_message
+        if user and passwd:
+            self.mqttc.username_pw_set(user, passwd)
+        self.mqttc.reconnect_delay_set(1, 120)
+        self.brokerFeedback = brokerFeedback
+        self.brokerSetting = brokerSetting
+        if self.mqtt_spool and os.path.exists(self.mqtt_spool):
+            with open(self.mqtt_spool, 'r') as f:
+                self.mqtt_stats['spooled'] = sum(1 for line in f)
+            self.log.info('{} MQTT messages spooled in {}'.format(self.mqtt_stats['spooled'], self.mqtt_spool))
+        self.mqtt_connect_task = asyncio.create_task(self.mqtt_connect(broker, port))
+        self.mqtt_task = asyncio.create_task(self.mqtt_publisher())
         return self.mqttc
         
+    def setup_metrics(self):
+        '''
+        declare the metrics served on /metrics
+        '''
+        m = metrics()
+        m.add('requests_total', 'counter', 'POSTs received from hubs', ('hub', 'status'))
+        m.add('request_seconds', 'histogram', 'time to handle a POST from a hub', ('hub',))
+        m.add('request_updates', 'histogram', 'number of updates in a POST from a hub', ('hub',), (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000))
+        m.add('last_seen_timestamp_seconds', 'gauge', 'time of the last POST from a hub', ('hub',))
+        m.add('process_seconds', 'histogram', 'time to process updates from a hub', ('hub',))
+        m.add('updates_total', 'counter', 'updates processed', ('hub',))
+        m.add('duplicates_total', 'counter', 'updates dropped as already processed (with -dd)', ('hub',))
+        m.add('mqtt_queued_total', 'counter', 'MQTT messages queued for publishing', ('hub',))
+        m.add('mqtt_connects_total', 'counter', 'MQTT broker connections', ('rc',))
+        m.add('mqtt_disconnects_total', 'counter', 'MQTT broker disconnections')
+        m.add('mqtt_commands_total', 'counter', 'commands and settings received from the MQTT broker', ('hub', 'command'))
+        m.add('decode_topics_seconds', 'histogram', 'time to publish changed config topics')
+        m.add('settings_write_requests_total', 'counter', 'requests to save the config file')
+        m.add('settings_write_seconds', 'histogram', 'time to write the config file')
+        m.add('loop_lag_seconds', 'histogram', 'event loop lag (with -dg)')
+        return m
+        
+    def hub_label(self, key):
+        '''
+        return the metrics label for hub key (api_key, id, mac, ip address or name): the hub's mac,
+        or 'unknown' if it is not in the settings, so clients can't create unlimited label sets
+        '''
+        return self.hub_index.get(key, 'unknown')
+        
+    def get_metrics(self):
+        '''
+        return metrics in the prometheus text format, with the current server statistics as gauges
+        '''
+        for group, stats in self.get_stats().items():
+            for stat, value in stats.items():
+                name = '{}_{}'.format(group, stat)
+                if name not in self.metrics.metrics:
+                    self.metrics.add(name, 'gauge', 'server statistics {} {}'.format(group, stat))
+                self.metrics.set(name, int(value) if isinstance(value, bool) else value)
+        return self.metrics.render()
+        
+    async def mqtt_connect(self, broker, port):
+        '''
+        connect to broker, retrying with backoff until connected
+        once connected paho handles reconnecting
+        '''
+        delay = 1
+        while True:
+            try:
+                await self.loop.run_in_executor(None, self.mqttc.connect, broker, port, 60)
+                self.mqttc.loop_start()
+                return
+            except socket.error as e:
+                self.log.error("Unable to connect to MQTT Broker: {}, retrying in {}s".format(e, delay))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 120)
+        
     def broker_on_connect(self, client, userdata, flags, rc):
         self.log.debug("MQTT Broker Connected with result code " + str(rc))
+        self.metrics.inc('mqtt_connects_total', (rc,))
         if rc == 0:
             client.subscribe('{}#'.format(self.brokerSetting))
+            self.mqtt_connected = True
+            self.wake_publisher()
+            self.loop.call_soon_threadsafe(self.broker_connected)
 
     def broker_on_disconnect(self, mosq, obj, rc):
         self.log.debug("MQTT Broker disconnected")
+        self.metrics.inc('mqtt_disconnects_total')
+        self.mqtt_connected = False
         
     def broker_on_message(self, mosq, obj, msg):
-        # receive commands and settings from broker
-        target = msg.topic.replace(self.brokerSetting,'').split('/')
-        payload = msg.payload.decode("utf-8")
+        # receive commands and settings from broker (in the paho thread), and handle them on the event loop
+        self.loop.call_soon_threadsafe(self.mqtt_command, msg.topic, msg.payload.decode("utf-8"))
+        
+    def mqtt_command(self, topic, payload):
+        '''
+        handle command or setting from broker, runs on the event loop
+        '''
+        target = topic.replace(self.brokerSetting,'').split('/')
         if not len(target):
             return
         vegehub = target[0] #mac address
+        changes = self.mqtt_changes(vegehub, target[1:], payload)
+        self.metrics.inc('mqtt_commands_total', (vegehub if vegehub in self.settings.keys() else '', payload if payload in ['get_config', 'refresh_config'] else 'batch' if len(changes) != 1 else 'update'))
         if payload == 'get_config':
-            self.decode_topics(self.settings)
+            self.decode_topics(self.settings, full=True)
         elif payload == 'refresh_config':
             if vegehub in self.settings.keys():
-                self.settings[vegehub] = {}
-                self.log.info('erased settings for {}, waiting for update'.format(vegehub))
+                self.set_settings(vegehub, {})
+                self.log.info('erased settings for %s, waiting for update', vegehub)
             else:
-                self.log.warning('No settings for Vegehub {} found'.format(vegehub))
+                self.log.warning('No settings for Vegehub %s found', vegehub)
         elif vegehub in self.settings.keys():
-            if self.update_settings(target, payload):
-                self.settings[vegehub]['who_updated'] = 2
-                self.settings[vegehub]["updated"] = self.now()
-                self.log.info('settings pending update: {}: {}'.format(target[-1], payload))
-                self.log.debug('settings pending update: {}'.format(pprint(self.settings)))
-            else:
-                self.log.warning('Settings not updated, {} not found in settings'.format(target))
+            try:
+                settings = self.update_settings(vegehub, changes)
+            except ValueError as e:
+                self.log.warning('Settings not updated for %s: %s', vegehub, e)
+                return
+            self.set_settings(vegehub, settings, who_updated=2)
+            self.log.info('settings pending update: %s: %s', vegehub, changes)
+            self.log.debug('settings pending update: %s', lazy_pprint(self.settings[vegehub]))
         else:
-            self.log.warning('Vegehub {} settings not found'.format(vegehub))
+            self.log.warning('Vegehub %s settings not found', vegehub)
             
-    def update_settings(self, keys, value, settings=None):
+    def mqtt_changes(self, mac, target, payload):
         '''
-        update settings with keys list to value
-        returns True if updated, False if setting not found
+        return {path: value} for setting from broker to target (list of topic levels after the mac address)
+        payload is a value, or a batch of values as a json object of {path (relative to target): value}
+        if target is a value in the settings of hub mac, payload is always a value (eg a url_param can be set to json)
         '''
-        try:
-            if not settings:
-                settings = self.settings[keys.pop(0)]   #key[0] is mac address
-                value = self.get_value(value)
-                
-            if not isinstance(settings[keys[0]], (dict, list)):
-                settings[keys[0]] = value
-                return True
-            elif isinstance(settings[keys[0]], dict):
-                settings[keys[0]][keys[1]] = value
-                return True
-            elif isinstance(settings[keys[0]], list):   #all lists are lists of dicts
-                for i in settings[keys[0]]:
-                    if isinstance(i, dict):             #should be all lists are lists of dicts
-                        if self.get_slot(i) == self.get_value(keys[1]):
-                            return self.update_settings(keys[2:], value, i)
-                    else:
-                        return self.update_settings(keys[1:], value, i)
-        except Exception as e:
-            self.log.error(e)
-        return False
+        path = '/'.join(target)
+        if payload.startswith('{') and not (mac in self.settings and path in self.get_paths(mac)):
+            try:
+                batch = self.serializer.loads(payload)
+                if isinstance(batch, dict):
+                    return {'/'.join(filter(None, [path, k])): v for k, v in batch.items()}
+            except ValueError:
+                pass
+        return {path: payload}
+            
+    def update_settings(self, mac, changes):
+        '''
+        return a copy of the settings of hub mac with changes ({path: value}) applied
+        paths are looked up in the hub's path index, values are converted to the type of the current value
+        raises ValueError, and nothing is changed, if any path is not found or any value is invalid,
+        or (with validation enabled) the new settings do not match the schema
+        '''
+        if not changes:
+            raise ValueError('no settings given')
+        settings = self.settings[mac]
+        paths = self.get_paths(mac)
+        for path, value in changes.items():
+            keys = paths.get(path)
+            if keys is None:
+                raise ValueError('{} not found in settings'.format(path))
+            settings = settings.replace(keys, self.get_value(value, settings.get_path(keys)))
+        if self.validate:
+            errors = self.schema_errors(settings.to_json(), hub=True)
+            if errors:
+                raise ValueError('invalid configuration: {}'.format(', '.join(errors[:20])))
+        return settings
+        
+    def get_paths(self, mac):
+        '''
+        return the path index of hub mac, which is built when first needed after the settings change
+        '''
+        paths = self.path_index.get(mac)
+        if paths is None:
+            paths = self.path_index[mac] = self.build_paths(self.settings[mac])
+        return paths
+        
+    def build_paths(self, settings, path=(), keys=(), paths=None):
+        '''
+        return path index {path: keys} for every value in settings (of one hub) that can be set from the broker
+        path is the topic levels joined with /, with items of lists identified by their slot (see get_slot)
+        keys is the tuple of keys (and list indexes) of the value in settings
+        if more than one item in a list has the same slot, the first is used
+        '''
+        if paths is None:
+            paths = {}
+        for k, v in settings.items():
+            if isinstance(v, (dict, model)):
+                self.build_paths(v, path + (k,), keys + (k,), paths)
+            elif isinstance(v, list):
+                for index, i in enumerate(v):
+                    if isinstance(i, (dict, model)):
+                        self.build_paths(i, path + (k, str(self.get_slot(i))), keys + (k, index), paths)
+            else:
+                paths.setdefault('/'.join(path + (k,)), keys + (k,))
+        return paths
     
-    def get_value(self, value):
+    def get_value(self, value, current=None):
         '''
-        converts string from MQTT to int, float or returns string
+        converts value from MQTT to the type of the current value
+        strings that are numbers are converted to int or float, unless the current value is a string
+        raises ValueError if the current value is a number (or a string) and value is not
+        (integer settings are checked by schema validation, the stored value's type does not say)
         '''
-        try:
-            v = int(value) if value.isdigit() else float(value)
-        except:
-            return value
-        return v
+        if isinstance(value, str) and not isinstance(current, str) and self.NUMBER.fullmatch(value):
+            value = float(value) if any(c in value for c in '.eE') else int(value)
+        if isinstance(current, str) and not isinstance(value, str):
+            raise ValueError('{} is not a string'.format(value))
+        if isinstance(current, (int, float)) and not isinstance(value, (int, float)):
+            raise ValueError('{} is not a number'.format(value))
+        return value
         
     def get_slot(self, i):
         return i.get('slot', i.get('idx', i.get('actuator_slot')))
@@ -166,36 +406,150 @@ class vegehubserver():
         api_key, id, ip address or name
         if mac can't be found returns the hub ip address (of last connected hub)
         '''
-        for mac, v in self.settings.items():
-            id = [x for x in ['api_key', 'id'] if v.get(x) == key]
-            if id or v['hub'].get('current_ip_addr') == key or v['hub'].get('name') == key:
-                return mac
-        return self.remote_host
+        return self.hub_index.get(key, self.remote_host)
+        
+    def set_settings(self, mac, settings, who_updated=None):
+        '''
+        replace the settings for hub mac, all changes to settings are made this way, on the event loop
+        stored hub settings are never changed in place, so copies of self.settings (eg being written to
+        the config file) stay consistent. settings (a json object or settings_model) is stored as a settings_model
+        who_updated (1: vegehub, 2: server) also sets "updated"
+        '''
+        if threading.get_ident() != self.loop_thread:
+            raise RuntimeError('settings can only be changed on the event loop')
+        if not isinstance(settings, model):
+            settings = settings_model.from_json(settings)
+        if who_updated is not None:
+            settings = settings.replace(('who_updated',), who_updated).replace(('updated',), self.now())
+        self.settings[mac] = settings
+        self.settings_changed(mac)
+        if self.worker:
+            self.worker.send({'op': 'set', 'mac': mac, 'settings': settings})
+        elif self.coordinator:
+            self.coordinator.send({'op': 'set', 'mac': mac, 'settings': settings})
+        
+    def settings_changed(self, mac):
+        '''
+        call when the settings for hub mac have been changed or replaced
+        updates the hub index and clears the cached responses for the hub
+        '''
+        self.index_hub(mac)
+        self.response_cache.pop(mac, None)
+        self.hub_cache.pop(mac, None)
+        self.path_index.pop(mac, None)
+        
+    def index_hub(self, mac):
+        '''
+        (re)index identity keys for hub mac in self.hub_index
+        removes stale keys if the hub has been removed or it's settings have changed
+        '''
+        for key in self.hub_index_keys.pop(mac, ()):
+            if self.hub_index.get(key) == mac:
+                del self.hub_index[key]
+        settings = self.settings.get(mac)
+        if settings is None:
+            return
+        hub = settings.get('hub', {})
+        keys = [settings.get('api_key'), settings.get('id'), mac, hub.get('current_ip_addr'), hub.get('name')]
+        keys = {key for key in keys if key}
+        for key in keys:
+            self.hub_index[key] = mac
+        self.hub_index_keys[mac] = keys
+        
+    def build_index(self):
+        '''
+        rebuild the hub identity index from self.settings
+        '''
+        self.hub_index = {}
+        self.hub_index_keys = {}
+        for mac in self.settings.keys():
+            self.index_hub(mac)
                        
-    def decode_topics(self, settings, prefix=None):
+    def flatten_topics(self, settings, prefix=None, topics=None):
         '''
-        decode json data dict, and publish as individual topics to
-        brokerFeedback/topic the keys are concatenated with _ to make one unique
-        topic name strings are expressly converted to strings to avoid unicode
-        representations
+        decode json data dict into a dict of topic: value the keys are concatenated
+        with _ to make one unique topic name strings are expressly converted to strings
+        to avoid unicode representations
         '''
+        if topics is None:
+            topics = {}
         for k, v in settings.items():
+            if isinstance(v, model):
+                v = v.to_json()
             if isinstance(v, dict):
                 if prefix is None:
-                    self.decode_topics(v, k)
+                    self.flatten_topics(v, k, topics)
                 else:
-                    self.decode_topics(v, '{}_{}'.format(prefix, k))
+                    self.flatten_topics(v, '{}_{}'.format(prefix, k), topics)
             else:
                 if isinstance(v, list):
                     for i in v:
                         if isinstance(i, dict):
-                            self.decode_topics(i, '{}_{}_{}'.format(prefix, k, self.get_slot(i)))
+                            self.flatten_topics(i, '{}_{}_{}'.format(prefix, k, self.get_slot(i)), topics)
                         else:
-                            self.decode_topics(i, '{}_{}'.format(prefix, k))
+                            self.flatten_topics(i, '{}_{}'.format(prefix, k), topics)
                             
             if prefix is not None:
                 k = '{}_{}'.format(prefix, k)        
-            self.publish(k, str(v))
+            topics[k] = str(v)
+        return topics
+                       
+    def decode_topics(self, settings, full=False, partial=False):
+        '''
+        decode json data dict of mac: hub settings, and publish as individual topics to
+        brokerFeedback/topic, returns the number of topics published
+        only topics that have changed since they were last published for that hub are sent,
+        removed topics are published as an empty string
+        full=True re-publishes all topics
+        partial=True publishes settings for the hubs given, without removing the topics of the others
+        in a worker process, topics are published by the coordinator
+        '''
+        if self.worker or not self.mqttc:
+            return 0
+        start = time.perf_counter()
+        published = suppressed = 0
+        for mac, hub in settings.items():
+            topics = self.flatten_topics({mac: hub})
+            last = self.published_topics.get(mac, {})
+            for k, v in topics.items():
+                if not full and last.get(k) == v:
+                    suppressed += 1
+                    continue
+                self.publish(k, v)
+                published += 1
+            self.remove_topics(k for k in last.keys() if k not in topics)
+            self.published_topics[mac] = topics
+        if not partial:
+            for mac in [mac for mac in self.published_topics.keys() if mac not in settings]:
+                self.remove_topics(self.published_topics.pop(mac).keys())
+        self.topic_stats['published'] += published
+        self.topic_stats['suppressed'] += suppressed
+        self.metrics.observe('decode_topics_seconds', time.perf_counter() - start)
+        self.log.debug('published %s config topics, %s unchanged', published, suppressed)
+        return published
+        
+    def remove_topics(self, topics):
+        '''
+        publish topics that are no longer in the settings as an empty string
+        '''
+        for k in topics:
+            self.publish(k, '')
+            self.topic_stats['removed'] += 1
+            
+    def broker_connected(self):
+        '''
+        called on the event loop when the broker connects
+        if MQTT messages were dropped while it was disconnected, some config topics may not have been published,
+        so they are all published again (in the background)
+        '''
+        if self.mqtt_stats['dropped'] == self.topics_dropped:
+            return
+        self.topics_dropped = self.mqtt_stats['dropped']
+        self.log.info('MQTT messages were dropped while disconnected, publishing all config topics')
+        self.published_topics = {}
+        if self.publish_task and not self.publish_task.done():
+            self.publish_task.cancel()
+        self.publish_task = asyncio.create_task(self.publish_settings())
     
     def get_id(self, i):
         '''
@@ -219,6 +573,20 @@ class vegehubserver():
                 return name if name else mac
         return id[0] if id else self.remote_host
     
+    def get_time(self, value):
+        '''
+        convert seconds since the epoch or iso date string (UTC if no timezone) to seconds since the epoch
+        '''
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            date_time = dt.datetime.fromisoformat(value)
+        if date_time.tzinfo is None:
+            date_time = date_time.replace(tzinfo=dt.timezone.utc)
+        return date_time.timestamp()
+        
     def now(self):
         '''
         returns UTC time in default javascript iso format as string
@@ -226,89 +594,270 @@ class vegehubserver():
         #return dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')   #"2021-05-25T15:20:52Z" UTC format
         return dt.datetime.utcnow().isoformat()[:-3]+'Z'    #UTC format 2021-05-26T20:05:35.392Z
         
-    def start_web(self):
+    async def start_web(self):
+        '''
+        serve the web port(s), returns once they are listening
+        '''
         routes = web.RouteTableDef()
         
+        @web.middleware
+        async def wait_for_settings(request, handler):
+            '''
+            hold requests received during startup until the settings are loaded
+            '''
+            if not self.settings_loaded.is_set():
+                await self.settings_loaded.wait()
+            return await handler(request)
+        
         @routes.get('/')
         async def index(request):
             self.log.debug('loading index.html')
-            return web.FileResponse('./index.html')
+            return self.asset_response(request, 'index.html')
             
         @routes.get('/api/{command}')
         async def api(request):
             command = request.match_info['command']
             if command == 'loadspec':
                 self.log.debug('sending spec.json')
-                return web.FileResponse('./spec.json', headers={"Content-Type": "text/plain"})
+                return self.asset_response(request, 'spec.json')
             elif command == 'loadjson':
-                self.log.debug('sending json to editor: {}'.format(self.settings))
-                return web.json_response(self.settings)
+                self.log.debug('sending json to editor: %s', self.settings)
+                return self.json_response(self.settings)
             elif command == 'getversion':
                 self.log.debug('sending version {}'.format(self.__version__))
                 return web.Response(text=self.__version__)
             elif command == 'getschema':
                 self.log.debug('sending vegehub_json_schema.json')
-                return web.FileResponse('./vegehub_json_schema.json', headers={"Content-Type": "text/plain"})
+                return self.asset_response(request, os.path.basename(self.schema_file))
+            elif command == 'getstats':
+                self.log.debug('sending stats')
+                return self.json_response(self.get_stats())
+            elif command == 'profile':
+                if not self.diagnostics:
+                    raise web.HTTPNotFound(reason='diagnostics are not enabled')
+                try:
+                    seconds = float(request.query.get('seconds', 10))
+                    filename = self.diagnostics.start_profile(seconds)
+                except ValueError as e:
+                    raise web.HTTPConflict(reason=str(e))
+                self.log.info('profiling event loop for %ss to %s', seconds, filename)
+                return self.json_response({'seconds': seconds, 'file': filename})
+            elif command == 'hubs':
+                self.log.debug('sending hub list')
+                return self.json_response({mac: self.get_hub(mac)[0] for mac in self.settings.keys()})
             raise web.HTTPBadRequest(reason='bad api call {}'.format(str(request.rel_url)))
             
+        @routes.get('/api/hub/{mac}')
+        async def get_hub(request):
+            '''
+            return the settings for one hub, with an ETag
+            returns 304 Not Modified if If-None-Match matches the current ETag
+            '''
+            mac = request.match_info['mac']
+            if mac not in self.settings:
+                raise web.HTTPNotFound(reason='unknown hub {}'.format(mac))
+            etag, body = self.get_hub(mac)
+            if etag in request.headers.get('If-None-Match', ''):
+                raise web.HTTPNotModified(headers={'ETag': etag})
+            self.log.debug('sending settings for %s to editor', mac)
+            return web.Response(body=body, content_type='application/json', headers={'ETag': etag})
+            
+        @routes.patch('/api/hub/{mac}')
+        async def patch_hub(request):
+            '''
+            apply a json patch (RFC 6902) to the settings for one hub, and return the new settings
+            returns 412 Precondition Failed if If-Match does not match the current ETag
+            '''
+            mac = request.match_info['mac']
+            if mac not in self.settings:
+                raise web.HTTPNotFound(reason='unknown hub {}'.format(mac))
+            if not request.can_read_body:
+                raise web.HTTPBadRequest(reason='bad api call {}'.format(str(request.rel_url)))
+            if_match = request.headers.get('If-Match')
+            if if_match and if_match != '*' and self.get_hub(mac)[0] not in if_match:
+                raise web.HTTPPreconditionFailed(reason='settings for {} have changed'.format(mac))
+            patch = await self.read_json(request)
+            self.log.info('received patch for %s: %s', mac, patch)
+            try:
+                self.patch_hub(mac, patch)
+            except ValueError as e:
+                self.log.warning('Invalid patch for %s: %s', mac, e)
+                if str(e).startswith('test failed'):
+                    raise web.HTTPConflict(text='Invalid patch: {}'.format(e))
+                raise web.HTTPBadRequest(text='Invalid patch: {}'.format(e))
+            etag, body = self.get_hub(mac)
+            return web.Response(body=body, content_type='application/json', headers={'ETag': etag})
+            
+        @routes.get('/metrics')
+        async def get_metrics(request):
+            return web.Response(body=self.get_metrics().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+            
+        @routes.get('/api/history/{hub}/{field}')
+        async def history(request):
+            '''
+            return stored readings for hub field as {"ts": [...], "values": [...]}
+            timestamps are UTC seconds since the epoch
+            query parameters from, to (seconds or iso date, UTC) and step (seconds to average over)
+            '''
+            if not self.history:
+                raise web.HTTPNotFound(reason='history is not enabled')
+            hub = request.match_info['hub']
+            field = request.match_info['field']
+            try:
+                start = self.get_time(request.query.get('from'))
+                end = self.get_time(request.query.get('to'))
+                step = float(request.query['step']) if request.query.get('step') else None
+            except ValueError as e:
+                raise web.HTTPBadRequest(reason='bad history query: {}'.format(e))
+            timestamps, values = await asyncio.get_running_loop().run_in_executor(None, self.history.query, hub, field, start, end, step)
+            self.log.debug('sending %s history points for %s %s', len(values), hub, field)
+            return self.json_response({'hub': hub, 'field': field, 'ts': timestamps, 'values': values})
+            
         @routes.post('/api/updatejson')
         async def updatejson(request):
             self.log.debug('received request to update json from editor')
             if request.can_read_body:
-                post_json = await request.json()
-                self.log.info('received: {}'.format(post_json))
-                self.log.debug(pprint(post_json))
+                post_json = await self.read_json(request)
+                self.log.info('received configuration for %s hubs from editor', len(post_json) if isinstance(post_json, dict) else 0)
+                self.log.debug('%s', lazy_pprint(post_json))
+                self.validate_settings(post_json)
                 self.check_update(post_json)
                 return web.Response(text="Updated")
             raise web.HTTPBadRequest(reason='bad api call {}'.format(str(request.rel_url)))
             
         @routes.post('/')
         async def recieved_update(request):
+            start = time.perf_counter()
             self.remote_host = request.remote
-            if request.can_read_body:
-                post_json = await request.json()
-                self.log.info('received: {}'.format(post_json))
-                self.log.debug(pprint(post_json))
-                await self.process_update(post_json)
-                who_updated, mac = await self.have_settings(post_json)
-                resp = {'who_updated' : who_updated}
-                if who_updated == 2:
-                    self.log.info('Sending updated settings:')
-                    resp.update(self.settings[mac])
-                self.log.info('sending response')
-                self.log.debug(pprint(resp))
-                return web.Response(body=json.dumps(resp), content_type='application/json')
-            raise web.HTTPBadRequest(reason='bad api call {}'.format(str(request.rel_url)))
+            hub = (self.hub_label(self.remote_host),)
+            status = 500
+            try:
+                if request.can_read_body:
+                    if self.stream_size and (request.content_length is None or request.content_length > self.stream_size):
+                        post_json = await self.stream_update(request)
+                        hub = (self.hub_label(self.get_channel_id(post_json)),)
+                    else:
+                        post_json = await self.read_json(request)
+                        if not isinstance(post_json, dict):
+                            raise web.HTTPBadRequest(reason='bad update {}'.format(post_json))
+                        hub_id = self.get_channel_id(post_json)
+                        self.log.info('received: %s with %s updates', hub_id, len(post_json.get('updates') or ()))
+                        self.log.debug('%s', lazy_pprint(post_json))
+                        hub = (self.hub_label(hub_id),)
+                        self.metrics.observe('request_updates', len(post_json.get('updates') or ()), hub)
+                        await self.ingest_update(post_json)
+                    who_updated, mac = await self.have_settings(post_json)
+                    resp, body = self.get_response(mac)
+                    if who_updated == 2:
+                        self.log.info('Sending updated settings:')
+                    self.log.info('sending response')
+                    self.log.debug('%s', lazy_pprint(resp))
+                    status = 200
+                    return web.Response(body=body, content_type='application/json')
+                raise web.HTTPBadRequest(reason='bad api call {}'.format(str(request.rel_url)))
+            except web.HTTPException as e:
+                status = e.status
+                raise
+            finally:
+                self.metrics.inc('requests_total', hub + (status,))
+                self.metrics.observe('request_seconds', time.perf_counter() - start, hub)
+                self.metrics.set('last_seen_timestamp_seconds', time.time(), hub)
             
         @routes.post('/configin')
         async def recieved_config_update(request):
             if request.can_read_body:
-                post_json = await request.json()
+                post_json = await self.read_json(request)
                 self.log.info('received configuration update')
-                self.log.debug(pprint(post_json))
+                self.log.debug('%s', lazy_pprint(post_json))
+                self.validate_settings(post_json, hub=True)
                 await self.save_settings(post_json)
                 return web.Response(text='{"who_updated" : 1}', content_type='application/json')
             raise web.HTTPBadRequest(reason='bad api call {}'.format(str(request.rel_url)))
 
-        self.app = web.Application()
+        self.app = web.Application(middlewares=[wait_for_settings])
         self.app.add_routes(routes)
+        self.runner = web.AppRunner(self.app, access_log=self.log)
+        await self.runner.setup()
         for webport in self.webport:
             self.log.info('Starting api WEB Server V{} on port {}'.format(self.__version__, webport))
-            self.web_task.append(asyncio.create_task(web._run_app(self.app, host='0.0.0.0', port=webport, print=None, access_log=self.log)))
-            self.log.info('Started WEB Server on port {}'.format(webport))
+            await web.TCPSite(self.runner, '0.0.0.0', webport, reuse_port=bool(self.worker)).start()
+            self.log.info('Started WEB Server on port {}, {:.3f}s after start'.format(webport, time.perf_counter() - START_TIME))
+        for filename in self.ASSETS.keys():
+            try:
+                self.get_asset(filename)
+            except web.HTTPNotFound:
+                pass
             
+    def get_validators(self):
+        '''
+        return (settings validator, hub validator) compiled from schema_file
+        validators are compiled again if the file changes
+        uses fastjsonschema if installed (compiled to python code), otherwise jsonschema
+        returns None if the schema is not available
+        '''
+        try:
+            mtime = os.stat(self.schema_file).st_mtime
+            if mtime != self.schema_mtime:
+                self.schema_mtime = mtime
+                self.validators = None
+                with open(self.schema_file, 'rb') as f:
+                    schema = self.serializer.loads(f.read())
+                hub_schema = {'$schema': schema.get('$schema'), '$ref': '#/$defs/vegehub', '$defs': schema.get('$defs', {})}
+                if HAVE_FASTJSONSCHEMA:
+                    self.validators = (fastjsonschema.compile(schema, use_formats=False), fastjsonschema.compile(hub_schema, use_formats=False))
+                else:
+                    cls = jsonschema.validators.validator_for(schema)
+                    cls.check_schema(schema)
+                    self.validators = (cls(schema), cls(hub_schema))
+                self.log.info('loaded schema {}'.format(self.schema_file))
+        except Exception as e:
+            self.log.error('Could not load schema {}: {}'.format(self.schema_file, e))
+        return self.validators
+        
+    def schema_errors(self, settings, hub=False):
+        '''
+        return list of schema errors as "path: message" for settings (all hubs)
+        or the settings of a single hub if hub is True
+        fastjsonschema only reports the first error
+        '''
+        validators = self.get_validators() if HAVE_JSONSCHEMA else None
+        if not validators:
+            return []
+        validator = validators[1 if hub else 0]
+        if HAVE_FASTJSONSCHEMA:
+            try:
+                validator(settings)
+            except fastjsonschema.JsonSchemaValueException as e:
+                return ['{}: {}'.format('/'.join(map(str, e.path[1:])) or '/', e.message[len(e.name):].strip())]
+            return []
+        errors = sorted(validator.iter_errors(settings), key=lambda e: list(map(str, e.absolute_path)))
+        return ['{}: {}'.format('/'.join(map(str, e.absolute_path)) or '/', e.message) for e in errors]
+        
+    def validate_settings(self, settings, hub=False):
+        '''
+        raise HTTPBadRequest listing the schema errors in settings, if validation is enabled
+        '''
+        if not isinstance(settings, dict):
+            raise web.HTTPBadRequest(text='Invalid configuration: not an object')
+        if self.validate:
+            errors = self.schema_errors(settings, hub)
+            if errors:
+                self.log.warning('Invalid configuration: %s', errors)
+                raise web.HTTPBadRequest(text='Invalid configuration:\n{}'.format('\n'.join(errors[:20])))
+                
     def check_update(self, post_json):
         '''
         compare an update from the json editor to save settings, and decide if a value was updated or not
         if so, update "updated" and 'who_updated" for that vegehub
         '''
         updated = False
-        for mac, value in self.settings.copy().items():
+        for mac, value in self.settings.items():
+            if mac not in post_json:
+                self.log.warning('No settings for %s in update, ignoring', mac)
+                continue
             if post_json[mac] != value:
-                self.log.info('Updating settings for: {}'.format(mac))
-                self.settings[mac] = post_json[mac]
-                self.settings[mac]["updated"] = self.now()
-                self.settings[mac]["who_updated"] = 2
+                self.log.info('Updating settings for: %s', mac)
+                self.set_settings(mac, post_json[mac], who_updated=2)
                 updated = True
         if updated:
             self.log.info('Saving Updates')
@@ -316,6 +865,174 @@ class vegehubserver():
         else:
             self.log.info('No settings changed')
         
+    def get_asset(self, filename):
+        '''
+        return (etag, {encoding: body}) for static file filename in BASE_DIR
+        the file is kept in memory, compressed, and re-read if it's mtime changes
+        '''
+        path = os.path.join(BASE_DIR, filename)
+        try:
+            mtime = os.stat(path).st_mtime
+            cached = self.assets.get(filename)
+            if cached is None or cached[0] != mtime:
+                with open(path, 'rb') as f:
+                    body = f.read()
+                bodies = {'identity': body, 'gzip': gzip.compress(body, 9)}
+                if HAVE_BROTLI:
+                    bodies['br'] = brotli.compress(body)
+                cached = self.assets[filename] = (mtime, hashlib.sha1(body).hexdigest(), bodies)
+                self.log.info('loaded %s (%s)', path, ', '.join('{}: {}'.format(k, len(v)) for k, v in bodies.items()))
+        except OSError as e:
+            self.log.error('Could not load %s: %s', path, e)
+            raise web.HTTPNotFound(reason='{} not found'.format(filename))
+        return cached[1:]
+        
+    def asset_response(self, request, filename):
+        '''
+        return static file filename, compressed if the client accepts it
+        returns 304 Not Modified if If-None-Match matches the ETag
+        '''
+        etag, bodies = self.get_asset(filename)
+        accept = {e.split(';')[0].strip() for e in request.headers.get('Accept-Encoding', '').split(',')}
+        encoding = next((e for e in ['br', 'gzip'] if e in bodies and e in accept), 'identity')
+        etag = '"{}"'.format(etag if encoding == 'identity' else '{}-{}'.format(etag, encoding))
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if etag in request.headers.get('If-None-Match', ''):
+            raise web.HTTPNotModified(headers=headers)
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return web.Response(body=bodies[encoding], content_type=self.ASSETS.get(filename, 'application/octet-stream'), headers=headers)
+        
+    async def read_json(self, request):
+        '''
+        decode json body of request, raises HTTPBadRequest if it is not valid json
+        '''
+        try:
+            return self.serializer.loads(await request.read())
+        except ValueError as e:
+            raise web.HTTPBadRequest(reason='invalid json: {}'.format(e))
+        
+    def json_response(self, obj):
+        return web.Response(body=self.serializer.encode(obj), content_type='application/json')
+        
+    def get_hub(self, mac):
+        '''
+        return (etag, encoded settings) for hub mac, cached until the hub settings change
+        '''
+        cached = self.hub_cache.get(mac)
+        if cached is None:
+            body = self.serializer.encode(self.settings[mac])
+            cached = self.hub_cache[mac] = ('"{}"'.format(hashlib.sha1(body).hexdigest()), body)
+        return cached
+        
+    def json_pointer(self, path):
+        '''
+        split a json pointer (RFC 6901) into a list of keys
+        '''
+        if not isinstance(path, str) or (path and not path.startswith('/')):
+            raise ValueError('invalid path: {}'.format(path))
+        return [key.replace('~1', '/').replace('~0', '~') for key in path.split('/')[1:]]
+        
+    def json_index(self, container, key, add=False):
+        '''
+        return key as a valid index of container (list index or dict key)
+        '''
+        if isinstance(container, list):
+            if add and key == '-':
+                return len(container)
+            if not key.isdigit() or (key != '0' and key.startswith('0')):
+                raise ValueError('invalid list index: {}'.format(key))
+            index = int(key)
+            if index > len(container) or (index == len(container) and not add):
+                raise ValueError('list index out of range: {}'.format(key))
+            return index
+        if isinstance(container, dict):
+            if key not in container and not add:
+                raise ValueError('path not found: {}'.format(key))
+            return key
+        raise ValueError('cannot index {} with {}'.format(type(container).__name__, key))
+        
+    def json_parent(self, doc, path):
+        '''
+        return (parent container, last key) for json pointer path in doc
+        '''
+        keys = self.json_pointer(path)
+        if not keys:
+            raise ValueError('cannot modify the whole document')
+        for key in keys[:-1]:
+            doc = doc[self.json_index(doc, key)]
+        return doc, keys[-1]
+        
+    def json_get(self, doc, path):
+        for key in self.json_pointer(path):
+            doc = doc[self.json_index(doc, key)]
+        return doc
+        
+    def json_remove(self, doc, path):
+        parent, key = self.json_parent(doc, path)
+        return parent.pop(self.json_index(parent, key))
+        
+    def json_add(self, doc, path, value):
+        parent, key = self.json_parent(doc, path)
+        index = self.json_index(parent, key, add=True)
+        if isinstance(parent, list):
+            parent.insert(index, value)
+        else:
+            parent[index] = value
+            
+    def apply_patch(self, doc, patch):
+        '''
+        apply a json patch (RFC 6902) to a copy of doc, and return the copy
+        raises ValueError if the patch is invalid, or a test operation fails
+        '''
+        if not isinstance(patch, list):
+            raise ValueError('patch must be a list of operations')
+        doc = copy.deepcopy(doc)
+        for operation in patch:
+            try:
+                op = operation['op']
+                path = operation['path']
+                if op == 'add':
+                    self.json_add(doc, path, copy.deepcopy(operation['value']))
+                elif op == 'remove':
+                    self.json_remove(doc, path)
+                elif op == 'replace':
+                    self.json_get(doc, path)
+                    self.json_remove(doc, path)
+                    self.json_add(doc, path, copy.deepcopy(operation['value']))
+                elif op == 'move':
+                    if path.startswith(operation['from'] + '/'):
+                        raise ValueError('cannot move {} into itself'.format(operation['from']))
+                    self.json_add(doc, path, self.json_remove(doc, operation['from']))
+                elif op == 'copy':
+                    self.json_add(doc, path, copy.deepcopy(self.json_get(doc, operation['from'])))
+                elif op == 'test':
+                    if self.json_get(doc, path) != operation['value']:
+                        raise ValueError('test failed: {}'.format(path))
+                else:
+                    raise ValueError('unknown op: {}'.format(op))
+            except (KeyError, TypeError, AttributeError) as e:
+                raise ValueError('invalid operation {}: {}'.format(operation, e))
+        return doc
+        
+    def patch_hub(self, mac, patch):
+        '''
+        apply a json patch from the editor to the settings for hub mac
+        if a value was changed, update "updated" and "who_updated" for the hub and save settings
+        returns True if the settings were changed
+        '''
+        settings = self.apply_patch(self.settings[mac].to_json(), patch)
+        if settings.get('mac', mac) != mac:
+            raise ValueError('cannot change mac of {}'.format(mac))
+        self.validate_settings(settings, hub=True)
+        if settings == self.settings[mac]:
+            self.log.info('No settings changed for: %s', mac)
+            return False
+        self.log.info('Updating settings for: %s', mac)
+        self.set_settings(mac, settings, who_updated=2)
+        self.write_settings()
+        return True
+        
     async def have_settings(self, post_json):
         '''
         data updates from hub V3.9 only contain api_key (as 'key')
@@ -324,12 +1041,27 @@ class vegehubserver():
         if so, return 'who_updated' and 'mac' address
         '''
         key = post_json.get('key')
-        for mac, settings in self.settings.items():
-            for k, v in settings.items():
-                if k == 'api_key'and v == key:
-                    return settings["who_updated"], mac
+        mac = self.hub_index.get(key) if key else None
+        if mac and self.settings[mac].get('api_key') == key:
+            return self.settings[mac]["who_updated"], mac
         return 0, None
     
+    def get_response(self, mac):
+        '''
+        return (response, encoded response) for a data update from hub mac
+        includes the hub settings if they have been updated (who_updated == 2)
+        the encoded response is cached until the hub settings change
+        '''
+        if mac is None:
+            return self.NO_SETTINGS_RESPONSE
+        cached = self.response_cache.get(mac)
+        if cached is None:
+            resp = {'who_updated' : self.settings[mac]["who_updated"]}
+            if resp['who_updated'] == 2:
+                resp.update(self.settings[mac])
+            cached = self.response_cache[mac] = (resp, self.serializer.encode(resp))
+        return cached
+        
     async def save_settings(self, post_json):
         mac = post_json['mac']
         if mac in self.settings.keys():
@@ -339,53 +1071,1383 @@ class vegehubserver():
                 self.log.info('settings updated')
         else:
             self.log.info('New vegehub {} found'.format(mac))
-        self.settings[mac] = post_json
-        self.decode_topics(self.settings)
+        self.set_settings(mac, post_json)
+        self.decode_topics({mac: self.settings[mac]}, partial=True)
         self.write_settings()
                 
     def write_settings(self):
-        with open(self.config_file, 'w') as f:
-            f.write(pprint(self.settings))
+        '''
+        mark settings as changed, and schedule a write of the config file
+        writes are coalesced over self.write_delay seconds
+        in a worker process, settings are written by the coordinator
+        '''
+        if self.worker:
+            return
+        self.settings_dirty = True
+        self.metrics.inc('settings_write_requests_total')
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            #no event loop, so write now
+            self.settings_dirty = False
+            self.write_settings_file(self.settings)
+            return
+        if not self.write_task or self.write_task.done():
+            self.write_task = asyncio.create_task(self.settings_writer())
+            
+    async def settings_writer(self):
+        '''
+        write settings to config file until there are no more changes pending
+        '''
+        while self.settings_dirty:
+            await asyncio.sleep(self.write_delay)
+            await self.flush_settings()
+            
+    async def flush_settings(self):
+        '''
+        write pending settings to config file (in an executor)
+        any changes made while writing mark the settings dirty again
+        '''
+        if self.write_future and not self.write_future.done():
+            await asyncio.wait([self.write_future])  #previous write still in progress
+        if not self.settings_dirty:
+            return
+        self.settings_dirty = False
+        try:
+            self.write_future = asyncio.get_running_loop().run_in_executor(None, self.write_settings_file, dict(self.settings))
+            await asyncio.shield(self.write_future)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log.error('Could not save settings: {}'.format(e))
+            self.settings_dirty = True
+            
+    def write_settings_file(self, settings):
+        '''
+        atomically write settings to config file
+        '''
+        start = time.perf_counter()
+        self.write_json_file(self.config_file, settings)
+        self.metrics.observe('settings_write_seconds', time.perf_counter() - start)
+        self.log.debug('settings written to {}'.format(self.config_file))
+        
+    def write_json_file(self, filename, obj):
+        '''
+        atomically write obj to filename as json (write temp file, then rename)
+        '''
+        tmp_file = '{}.tmp'.format(filename)
+        data = self.serializer.encode(obj) if self.compact_config else self.serializer.pretty(obj).encode()
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, filename)
+        
+    def load_watermarks(self):
+        if not os.path.exists(self.watermark_file):
+            return {}
+        return self.load_settings(self.watermark_file)
+        
+    def watermark_changed(self, hub):
+        '''
+        the watermark for hub has advanced, schedule a write of the watermark file
+        in a worker process, the watermark is sent to the coordinator which writes the file
+        and sends it to all workers
+        '''
+        if self.worker:
+            self.worker.send({'op': 'watermark', 'hub': hub, 'ts': self.replays.watermarks[hub]})
+            return
+        if self.coordinator:
+            self.coordinator.send({'op': 'watermark', 'hub': hub, 'ts': self.replays.watermarks[hub]})
+        self.watermarks_dirty = True
+        if not self.watermark_task or self.watermark_task.done():
+            self.watermark_task = asyncio.create_task(self.watermark_writer())
+            
+    async def watermark_writer(self):
+        while self.watermarks_dirty:
+            await asyncio.sleep(self.write_delay)
+            await self.flush_watermarks()
             
+    async def flush_watermarks(self):
+        '''
+        write watermarks to watermark_file (in an executor)
+        '''
+        if not self.watermarks_dirty:
+            return
+        self.watermarks_dirty = False
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.write_json_file, self.watermark_file, dict(self.replays.watermarks))
+        except OSError as e:
+            self.log.error('Could not save watermarks: {}'.format(e))
+            
+    def compact_settings(self, settings):
+        '''
+        convert settings loaded from json to a settings_model for each hub
+        '''
+        return {mac: settings_model.from_json(hub) for mac, hub in settings.items()}
+        
     def load_settings(self, filename=None):
         try:
             if not filename:
                 filename = self.config_file
-            with open(filename, 'r') as f:
-                settings = json.loads(f.read())
+            with open(filename, 'rb') as f:
+                settings = self.serializer.loads(f.read())
             return settings
         except Exception as e:
             self.log.warning('Could not load settings: {}'.format(e))
         return {}
     
+    async def ingest_update(self, post_json):
+        '''
+        process update now, or queue it if the ingest queue is enabled
+        '''
+        if self.ingest_queue:
+            await self.enqueue_update(post_json)
+        else:
+            await self.timed_update(post_json)
+            
+    async def timed_update(self, post_json):
+        '''
+        process_update, recording the time taken and number of updates for the hub
+        updates already processed are dropped first (if enabled)
+        '''
+        if self.replays and post_json.get('updates'):
+            hub = self.get_channel_id(post_json)
+            watermark = self.replays.watermarks.get(hub)
+            updates, dropped = self.replays.filter(hub, post_json['updates'])
+            if self.replays.watermarks.get(hub) != watermark:
+                self.watermark_changed(hub)
+            if dropped:
+                self.ingest_stats['duplicates'] += dropped
+                self.metrics.inc('duplicates_total', (self.hub_label(hub),), dropped)
+                self.log.info('dropped %s already processed updates from %s', dropped, hub)
+                if not updates:
+                    return
+                post_json = dict(post_json, updates=updates)
+        start = time.perf_counter()
+        try:
+            await self.process_update(post_json)
+        finally:
+            hub = (self.hub_label(self.get_channel_id(post_json)),)
+            self.metrics.observe('process_seconds', time.perf_counter() - start, hub)
+            self.metrics.inc('updates_total', hub, len(post_json.get('updates') or ()))
+            
+    async def stream_update(self, request):
+        '''
+        parse large update from request as it arrives, processing updates in chunks of STREAM_CHUNK
+        updates are held until the hub id (key or channel_id) has been received, or the object ends
+        returns the update without the 'updates' list
+        '''
+        header = {}
+        chunk = []
+        count = 0
+        try:
+            async for update in self.stream_json(request.content, header, 'updates'):
+                chunk.append(update)
+                if len(chunk) >= self.STREAM_CHUNK and (header.get('channel_id') or header.get('key')):
+                    count += len(chunk)
+                    await self.ingest_update(dict(header, updates=chunk))
+                    chunk = []
+        except ValueError as e:
+            raise web.HTTPBadRequest(reason='bad update: {}'.format(e))
+        if chunk or not count:
+            count += len(chunk)
+            await self.ingest_update(dict(header, updates=chunk) if chunk else header)
+        self.log.info('received: %s with %s updates (streamed)', self.get_channel_id(header), count)
+        self.log.debug('%s', lazy_pprint(header))
+        self.metrics.observe('request_updates', count, (self.hub_label(self.get_channel_id(header)),))
+        return header
+            
+    async def stream_json(self, stream, header, list_key):
+        '''
+        incrementally parse a json object from stream, yielding the items of list_key
+        as they are received, other keys in the object are added to header.
+        only whitespace may follow the object.
+        raises ValueError if the json is invalid
+        '''
+        decoder = json.JSONDecoder()
+        text = codecs.getincrementaldecoder('utf-8')()
+        buf, pos, eof = '', 0, False
+        state, key = 'start', None
+        while True:
+            pos = self.JSON_WS.match(buf, pos).end()
+            if pos > 65536:
+                buf, pos = buf[pos:], 0
+            try:
+                if pos >= len(buf):
+                    if state == 'end' and eof:
+                        return
+                    raise json.JSONDecodeError('unexpected end of data', buf, pos)
+                c = buf[pos]
+                if state == 'end':
+                    raise ValueError('unexpected data after object at {}'.format(pos))
+                if state == 'start':
+                    if c != '{':
+                        raise ValueError('expected object')
+                    pos, state = pos + 1, 'first key'
+                elif state in ('first key', 'key'):
+                    if c == '}' and state == 'first key':
+                        pos, state = pos + 1, 'end'
+                        continue
+                    key, end = decoder.raw_decode(buf, pos)
+                    end = self.JSON_WS.match(buf, end).end()
+                    if end >= len(buf):
+                        raise json.JSONDecodeError('need more data', buf, end)
+                    if buf[end] != ':' or not isinstance(key, str):
+                        raise ValueError('expected key at {}'.format(pos))
+                    pos, state = end + 1, 'value'
+                elif state == 'value':
+                    if key == list_key and c == '[':
+                        pos, state = pos + 1, 'first item'
+                        continue
+                    header[key], pos = self.json_value(decoder, buf, pos, '},', eof)
+                    state = 'next key'
+                elif state == 'next key':
+                    if c == '}':
+                        pos, state = pos + 1, 'end'
+                        continue
+                    if c != ',':
+                        raise ValueError('expected , or }} at {}'.format(pos))
+                    pos, state = pos + 1, 'key'
+                elif state in ('first item', 'item'):
+                    if c == ']' and state == 'first item':
+                        pos, state = pos + 1, 'next key'
+                        continue
+                    item, pos = self.json_value(decoder, buf, pos, '],', eof)
+                    state = 'next item'
+                    yield item
+                elif state == 'next item':
+                    if c == ']':
+                        pos, state = pos + 1, 'next key'
+                        continue
+                    if c != ',':
+                        raise ValueError('expected , or ] at {}'.format(pos))
+                    pos, state = pos + 1, 'item'
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise ValueError(str(e))
+                data = await stream.read(65536)
+                eof = not data
+                buf += text.decode(data, final=eof)
+                
+    def json_value(self, decoder, buf, pos, delimiters, eof):
+        '''
+        decode json value from buf at pos, which must be followed by one of delimiters
+        (so that numbers split across reads are not decoded early)
+        returns value, position of delimiter
+        '''
+        value, end = decoder.raw_decode(buf, pos)
+        end = self.JSON_WS.match(buf, end).end()
+        if end >= len(buf):
+            raise json.JSONDecodeError('unexpected end of data', buf, end)
+        if buf[end] not in delimiters:
+            if not eof and isinstance(value, (int, float)) and self.JSON_NUMBER.fullmatch(buf, end):
+                raise json.JSONDecodeError('number may be incomplete', buf, end)
+            raise ValueError('expected one of {} at {}'.format(delimiters, end))
+        return value, end
+        
+    def start_ingest(self):
+        '''
+        start ingest queue and workers if queue_size is set
+        updates are then processed after the response has been sent to the hub
+        '''
+        if self.queue_size <= 0:
+            return
+        self.log.info('Starting ingest queue, size: {}, workers: {}'.format(self.queue_size, self.queue_workers))
+        self.ingest_queue = asyncio.Queue(self.queue_size)
+        for i in range(max(1, self.queue_workers)):
+            self.ingest_tasks.append(asyncio.create_task(self.ingest_worker()))
+            
+    async def enqueue_update(self, post_json):
+        '''
+        put update on the ingest queue, if the queue is full either wait for space
+        or return 503 (service unavailable) so that the hub resends later
+        queued updates are stored as update_models, to save memory with a large backlog
+        '''
+        if isinstance(post_json.get('updates'), list):
+            post_json = dict(post_json, updates=[update_model.from_json(update) for update in post_json['updates']])
+        try:
+            if self.queue_block:
+                await self.ingest_queue.put((self.remote_host, post_json))
+            else:
+                self.ingest_queue.put_nowait((self.remote_host, post_json))
+        except asyncio.QueueFull:
+            self.ingest_stats['rejected'] += 1
+            self.log.warning('Ingest queue full, rejecting update from %s', self.remote_host)
+            raise web.HTTPServiceUnavailable(reason='update queue full')
+        self.ingest_stats['enqueued'] += 1
+        self.ingest_stats['max_depth'] = max(self.ingest_stats['max_depth'], self.ingest_queue.qsize())
+        
+    async def ingest_worker(self):
+        '''
+        process updates from the ingest queue
+        '''
+        while True:
+            remote_host, post_json = await self.ingest_queue.get()
+            try:
+                self.remote_host = remote_host
+                await self.timed_update(post_json)
+                self.ingest_stats['processed'] += 1
+            except Exception as e:
+                self.log.exception(e)
+            finally:
+                self.ingest_queue.task_done()
+                
+    def get_stats(self):
+        '''
+        return dict of server statistics
+        '''
+        stats = {'topics': self.topic_stats, 'ingest': self.ingest_stats,
+                 'mqtt': dict(self.mqtt_stats, buffered=len(self.mqtt_buffer), connected=self.mqtt_connected)}
+        if self.ingest_queue:
+            stats['ingest'] = dict(self.ingest_stats, depth=self.ingest_queue.qsize(), size=self.queue_size)
+        if self.diagnostics:
+            stats['loop'] = self.diagnostics.stats
+        return stats
+        
     async def process_update(self, post_json):
         '''
         override this to process your own data in a super class
         '''
         channel = self.get_channel_id(post_json)
         if 'updates' in post_json.keys():
+            self.store_updates(channel, post_json['updates'])
             for update in post_json['updates']:
                 for k, v in update.items():
                     self.publish(k, v, channel)
         
+    def store_updates(self, hub_id, updates):
+        '''
+        store numeric fields of updates in history (if enabled)
+        records are appended to the store by history_writer, off the event loop
+        in a worker process, updates are sent to the coordinator to store
+        '''
+        if not self.history:
+            return
+        if self.worker:
+            self.worker.send({'op': 'history', 'hub': hub_id, 'updates': updates})
+            return
+        for update in updates:
+            ts = utc_timestamp(update['created_at']) if update.get('created_at') else time.time()
+            for k, v in update.items():
+                if isinstance(v, (int, float)) and not isinstance(v, bool):
+                    self.history_pending.setdefault((hub_id, k), []).append((ts, v))
+        if not self.history_task or self.history_task.done():
+            self.history_task = asyncio.create_task(self.history_writer())
+            
+    async def history_writer(self):
+        '''
+        append pending history records to the store (in an executor) until there are none left
+        records received while writing are appended together in the next pass
+        '''
+        while self.history_pending:
+            pending, self.history_pending = self.history_pending, {}
+            try:
+                await self.loop.run_in_executor(None, self.append_history, pending)
+            except OSError as e:
+                self.log.error('Could not store history: {}'.format(e))
+                
+    def append_history(self, pending):
+        '''
+        append {(hub, field): [(timestamp, value),...]} to the history store, runs in an executor
+        '''
+        for (hub_id, field), records in pending.items():
+            self.history.append(hub_id, field, records)
+        
     def publish(self, topic, msg, hub_id=None):
-        if self.mqttc:
+        '''
+        queue message for publishing (see queue_message)
+        if the broker is disconnected and the buffer is full, messages are spooled to disk (if configured) or the oldest is dropped
+        '''
+        if self.mqttc or self.worker:
             topic = '{}{}{}'.format(self.brokerFeedback, '{}/'.format(hub_id) if hub_id else '', topic)
-            self.mqttc.publish(topic, msg)    
+            self.metrics.inc('mqtt_queued_total', (self.hub_label(hub_id) if hub_id else '',))
+            if self.worker:
+                self.worker.publish(topic, msg)
+            else:
+                self.queue_message(topic, msg)
+                
+    def queue_message(self, topic, msg):
+        '''
+        publish message if the broker is connected and nothing is waiting, otherwise add it to the buffer for mqtt_publisher
+        the buffer size is only limited while the broker is disconnected
+        '''
+        if self.mqtt_connected and not self.mqtt_buffer and not self.mqtt_stats['spooled']:
+            if self.mqttc.publish(topic, msg).rc == paho.MQTT_ERR_SUCCESS:
+                self.mqtt_stats['published'] += 1
+                return
+            self.mqtt_connected = self.mqttc.is_connected()
+        if self.mqtt_stats['spooled'] or (not self.mqtt_connected and len(self.mqtt_buffer) >= self.mqtt_buffer_size):
+            if self.mqtt_spool:
+                self.spool_message(topic, msg)
+                return
+            self.mqtt_buffer.popleft()
+            self.mqtt_stats['dropped'] += 1
+        self.mqtt_buffer.append((topic, msg))
+        self.wake_publisher()
+            
+    def wake_publisher(self):
+        '''
+        signal mqtt_publisher that there is something to do, can be called from any thread
+        '''
+        if threading.get_ident() == self.loop_thread:
+            self.mqtt_wakeup.set()
+        else:
+            self.loop.call_soon_threadsafe(self.mqtt_wakeup.set)
+            
+    async def mqtt_publisher(self):
+        '''
+        publish buffered messages in batches while the broker is connected
+        '''
+        while True:
+            await self.mqtt_wakeup.wait()
+            self.mqtt_wakeup.clear()
+            while self.mqtt_connected and (self.mqtt_buffer or self.mqtt_stats['spooled']):
+                if not self.mqtt_buffer:
+                    self.load_spool()
+                for i in range(min(self.mqtt_batch, len(self.mqtt_buffer))):
+                    topic, msg = self.mqtt_buffer[0]
+                    if self.mqttc.publish(topic, msg).rc != paho.MQTT_ERR_SUCCESS:
+                        self.log.warning('MQTT publish failed, {} messages buffered'.format(len(self.mqtt_buffer)))
+                        self.mqtt_connected = self.mqttc.is_connected()
+                        await asyncio.sleep(1)
+                        break
+                    self.mqtt_buffer.popleft()
+                    self.mqtt_stats['published'] += 1
+                await asyncio.sleep(0)
+                
+    def spool_message(self, topic, msg):
+        '''
+        append message to spool file
+        '''
+        try:
+            with open(self.mqtt_spool, 'a', encoding='utf-8') as f:
+                f.write(self.serializer.dumps([topic, msg])+'\n')
+            self.mqtt_stats['spooled'] += 1
+        except Exception as e:
+            self.log.error('Could not spool message: {}'.format(e))
+            self.mqtt_stats['dropped'] += 1
+            
+    def load_spool(self):
+        '''
+        move messages from spool file to buffer, remove spool file when all messages are loaded
+        '''
+        try:
+            with open(self.mqtt_spool, 'r', encoding='utf-8') as f:
+                f.seek(self.spool_offset)
+                while len(self.mqtt_buffer) < self.mqtt_buffer_size:
+                    line = f.readline()
+                    if not line:
+                        break
+                    self.mqtt_buffer.append(tuple(self.serializer.loads(line)))
+                    self.mqtt_stats['spooled'] -= 1
+                self.spool_offset = f.tell()
+                eof = not f.readline()
+        except Exception as e:
+            self.log.error('Could not load spooled messages: {}'.format(e))
+            eof = True
+        if eof:
+            self.mqtt_stats['dropped'] += max(0, self.mqtt_stats['spooled'])
+            self.mqtt_stats['spooled'] = 0
+            self.spool_offset = 0
+            if os.path.exists(self.mqtt_spool):
+                os.remove(self.mqtt_spool)
+        
+    def save_spool(self):
+        '''
+        write buffered messages, followed by the spooled messages not loaded yet, to a new spool file
+        so nothing is lost at shutdown and the messages are published in order at the next start
+        '''
+        temp = self.mqtt_spool + '.tmp'
+        try:
+            with open(temp, 'w', encoding='utf-8') as out:
+                for topic, msg in self.mqtt_buffer:
+                    out.write(self.serializer.dumps([topic, msg])+'\n')
+                if self.mqtt_stats['spooled'] and os.path.exists(self.mqtt_spool):
+                    with open(self.mqtt_spool, 'r', encoding='utf-8') as f:
+                        f.seek(self.spool_offset)
+                        shutil.copyfileobj(f, out)
+            os.replace(temp, self.mqtt_spool)
+        except Exception as e:
+            self.log.error('Could not spool messages: {}'.format(e))
+            self.mqtt_stats['dropped'] += len(self.mqtt_buffer)
+        else:
+            self.mqtt_stats['spooled'] += len(self.mqtt_buffer)
+            self.spool_offset = 0
+        self.mqtt_buffer.clear()
         
     async def cancel(self):
         '''
-        shutdown web server
+        shutdown web server, and save any pending settings
         '''
+        for task in [self.startup_task, self.publish_task]:
+            if task and not task.done():
+                task.cancel()
+        if self.coordinator:
+            await self.coordinator.stop()
+        if self.ingest_queue:
+            try:
+                await asyncio.wait_for(self.ingest_queue.join(), 10)
+            except asyncio.TimeoutError:
+                self.log.warning('{} updates not processed'.format(self.ingest_queue.qsize()))
+            for task in self.ingest_tasks:
+                task.cancel()
+        if self.worker:
+            await self.worker.close()
+        if self.history_task:
+            await self.history_task     #store pending history
+        if self.write_task and not self.write_task.done():
+            self.write_task.cancel()
+        await self.flush_settings()
+        if self.watermark_task and not self.watermark_task.done():
+            self.watermark_task.cancel()
+        await self.flush_watermarks()
         if self.mqttc:
+            if self.mqtt_connected:
+                for i in range(50):
+                    if not self.mqtt_buffer:
+                        break
+                    await asyncio.sleep(0.1)
+            for task in [self.mqtt_task, self.mqtt_connect_task]:
+                if task and not task.done():
+                    task.cancel()
+            if self.mqtt_buffer:
+                if self.mqtt_spool:
+                    self.log.info('spooling {} unsent MQTT messages'.format(len(self.mqtt_buffer)))
+                    self.save_spool()
+                else:
+                    self.log.warning('{} unsent MQTT messages discarded'.format(len(self.mqtt_buffer)))
+                    self.mqtt_stats['dropped'] += len(self.mqtt_buffer)
+            self.mqttc.disconnect()
             self.mqttc.loop_stop()
-        if self.app:
-            await self.app.shutdown()
-            await self.app.cleanup()
-        if self.web_task:
-            for webtask in self.webtask:
-                if not web_task.done():
-                    web_task.cancel()  
+        if self.runner:
+            await self.runner.cleanup()
+        if self.diagnostics:
+            self.diagnostics.stop()
+
+class model():
+    '''
+    Compact representation of a json object, known keys (FIELDS) are stored in __slots__ instead
+    of a dict, any other keys are kept in extra, and missing keys are left unset, so to_json()
+    returns the same object that was loaded. Nested objects listed in MODELS are converted too.
+    Has a read only mapping interface (get, [], keys, items) so it can be used in place of the dict,
+    models are never changed in place, use to_json() to get a copy to modify.
+    '''
+    __slots__ = ('extra',)
+    FIELDS = ()
+    MODELS = {}     #key: model for nested objects (or lists of objects)
+    INTERN = 32     #strings up to this length are interned, as most are repeated
+    
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.KEYS = frozenset(cls.FIELDS)
+    
+    @classmethod
+    def from_json(cls, obj):
+        '''
+        convert json object (dict) obj to this model, anything else is returned unchanged
+        '''
+        if not isinstance(obj, dict):
+            return obj
+        self = cls.__new__(cls)
+        for key, value in obj.items():
+            nested = cls.MODELS.get(key)
+            if nested:
+                value = [nested.from_json(v) for v in value] if isinstance(value, list) else nested.from_json(value)
+            elif isinstance(value, str) and len(value) <= cls.INTERN:
+                value = sys.intern(value)
+            if key in cls.KEYS:
+                setattr(self, key, value)
+            else:
+                try:
+                    self.extra[key] = value
+                except AttributeError:
+                    self.extra = {key: value}
+        return self
+        
+    @staticmethod
+    def json_value(value):
+        if isinstance(value, model):
+            return value.to_json()
+        if isinstance(value, list):
+            return [model.json_value(v) for v in value]
+        if isinstance(value, dict):
+            return copy.deepcopy(value)
+        return value
+        
+    def to_json(self):
+        '''
+        return a (new) json object (dict) of this model
+        '''
+        obj = {}
+        for key in self.FIELDS:
+            value = getattr(self, key, obj)     #obj is never a value, so means unset
+            if value is not obj:
+                obj[key] = self.json_value(value) if isinstance(value, (model, list, dict)) else value
+        if hasattr(self, 'extra'):
+            obj.update((key, self.json_value(value)) for key, value in self.extra.items())
+        return obj
+        
+    def copy(self):
+        '''
+        return a shallow copy of this model
+        '''
+        new = self.__class__.__new__(self.__class__)
+        for key in self.FIELDS:
+            value = getattr(self, key, new)
+            if value is not new:
+                setattr(new, key, value)
+        if hasattr(self, 'extra'):
+            new.extra = dict(self.extra)
+        return new
+        
+    def replace(self, keys, value):
+        '''
+        return a copy of this model with the value at keys (a sequence of keys and list indexes) replaced
+        objects that are not changed are shared with this model, not copied
+        '''
+        key = keys[0]
+        if len(keys) > 1:
+            container = self[key]
+            value = container.replace(keys[1:], value) if isinstance(container, model) else model.replace_item(container, keys[1:], value)
+        new = self.copy()
+        if key in self.KEYS:
+            setattr(new, key, value)
+        elif hasattr(new, 'extra'):
+            new.extra[key] = value
+        else:
+            new.extra = {key: value}
+        return new
+        
+    @staticmethod
+    def replace_item(container, keys, value):
+        '''
+        return a shallow copy of container (a list or dict) with the value at keys replaced
+        '''
+        container = copy.copy(container)
+        if len(keys) > 1:
+            item = container[keys[0]]
+            value = item.replace(keys[1:], value) if isinstance(item, model) else model.replace_item(item, keys[1:], value)
+        container[keys[0]] = value
+        return container
+        
+    def get_path(self, keys):
+        '''
+        return the value at keys (a sequence of keys and list indexes)
+        '''
+        value = self
+        for key in keys:
+            value = value[key]
+        return value
+        
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key) if key in self.KEYS else self.extra[key]
+        except AttributeError:
+            raise KeyError(key)
+            
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+            
+    def keys(self):
+        keys = [key for key in self.FIELDS if hasattr(self, key)]
+        if hasattr(self, 'extra'):
+            keys.extend(self.extra.keys())
+        return keys
+        
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+        
+    def __contains__(self, key):
+        return key in self.keys()
+        
+    def __iter__(self):
+        return iter(self.keys())
+        
+    def __len__(self):
+        return len(self.keys())
+        
+    def __eq__(self, other):
+        if isinstance(other, model):
+            other = other.to_json()
+        return self.to_json() == other
+        
+    __hash__ = None
+        
+    def __repr__(self):
+        return repr(self.to_json())
+        
+
+class hub_model(model):
+    __slots__ = FIELDS = ('model', 'firmware_version', 'wifi_version', 'utc_offset', 'name', 'sample_period', 'update_period',
+                          'blink_update', 'report_voltage', 'server_url', 'static_ip_addr', 'dns', 'subnet', 'gateway',
+                          'current_ip_addr', 'power_mode')
+    
+class sensor_model(model):
+    __slots__ = FIELDS = ('slot', 'mode', 'warm_up', 'pull_up', 'always_power', 'update_on_trigger', 'edge')
+    
+class condition_model(model):
+    __slots__ = FIELDS = ('sequence', 'slot', 'operator', 'lower', 'upper', 'hysteresis', 'chain')
+    
+class actuator_model(model):
+    __slots__ = FIELDS = ('name', 'slot', 'type', 'enabled', 'mode', 'url', 'url_param', 'turn_on', 'time_dependent',
+                          'start_time', 'end_time', 'days_of_week', 'conditions')
+    MODELS = {'conditions': condition_model}
+    
+class action_model(model):
+    __slots__ = FIELDS = ('enabled', 'actuator_slot', 'duration')
+    
+class schedule_model(model):
+    __slots__ = FIELDS = ('name', 'idx', 'enabled', 'mode', 'days_of_week', 'period', 'start_time', 'actions')
+    MODELS = {'actions': action_model}
+    
+class web_condition_model(model):
+    __slots__ = FIELDS = ('actuator_slot', 'name', 'condition_key')
+    
+class schedule_override_model(model):
+    __slots__ = FIELDS = ('id', 'start_time', 'duration', 'actuator_slot', 'action_type')
+    
+class settings_model(model):
+    '''
+    settings for one hub, as in vegehub_json_schema.json (fields in the order of spec.json)
+    '''
+    __slots__ = FIELDS = ('api_key', 'mac', 'route_key', 'id', 'updated', 'who_updated', 'hub', 'sensors', 'actuators',
+                          'schedules', 'web_conditions', 'schedule_overrides')
+    MODELS = {'hub': hub_model, 'sensors': sensor_model, 'actuators': actuator_model, 'schedules': schedule_model,
+              'web_conditions': web_condition_model, 'schedule_overrides': schedule_override_model}
+              
+class update_model(model):
+    '''
+    one reading from a hub data update
+    '''
+    __slots__ = FIELDS = ('created_at', 'field1', 'field2', 'field3', 'field4', 'field5', 'field6', 'field7', 'field8')
+    INTERN = 0      #timestamps are unique, so interning them only adds to the intern table
+    
+    
+def to_json(obj):
+    '''
+    json.dumps default, converts models to json objects
+    '''
+    if isinstance(obj, model):
+        return obj.to_json()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+class lazy_module():
+    '''
+    Stands in for module name, which is imported when an attribute is first used
+    attributes are then cached on this object
+    '''
+    def __init__(self, name):
+        self.__dict__['module_name'] = name
+
+    def __getattr__(self, attr):
+        value = getattr(importlib.import_module(self.module_name), attr)
+        setattr(self, attr, value)
+        return value
+
+paho = lazy_module('paho.mqtt.client')
+np = lazy_module('numpy')
+fastjsonschema = lazy_module('fastjsonschema')
+jsonschema = lazy_module('jsonschema')
+brotli = lazy_module('brotli')
+orjson = lazy_module('orjson')
+ujson = lazy_module('ujson')
+multiprocessing = lazy_module('multiprocessing')    #only used to start workers
+
+
+class json_codec():
+    '''
+    json encoding and decoding with orjson or ujson if installed, falling back to json (stdlib)
+    loads accepts str or bytes, encode returns bytes, dumps returns str (both compact)
+    pretty returns str indented, with sorted keys. models are encoded with to_json()
+    '''
+    BACKENDS = {'orjson': HAVE_ORJSON, 'ujson': HAVE_UJSON, 'json': True}   #in order of preference
+    
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = next(name for name, available in self.BACKENDS.items() if available)
+        if not self.BACKENDS.get(backend):
+            raise ValueError('json backend {} is not installed'.format(backend))
+        self.backend = backend
+        
+    def loads(self, data):
+        '''
+        replaced by the backend's loads on first use, so the backend is not imported until it is needed
+        '''
+        self.loads = orjson.loads if self.backend == 'orjson' else ujson.loads if self.backend == 'ujson' else json.loads
+        return self.loads(data)
+        
+    def encode(self, obj):
+        if self.backend == 'orjson':
+            return orjson.dumps(obj, default=to_json, option=orjson.OPT_NON_STR_KEYS)
+        return self.dumps(obj).encode()
+        
+    def dumps(self, obj):
+        if self.backend == 'orjson':
+            return self.encode(obj).decode()
+        if self.backend == 'ujson':
+            return ujson.dumps(obj, default=to_json, ensure_ascii=False, escape_forward_slashes=False)
+        return json.dumps(obj, default=to_json, separators=(',', ':'))
+        
+    def pretty(self, obj):
+        if self.backend == 'orjson':
+            return orjson.dumps(obj, default=to_json, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS).decode()
+        if self.backend == 'ujson':
+            return ujson.dumps(self.plain(obj), ensure_ascii=False, escape_forward_slashes=False, indent=2, sort_keys=True)
+        return json.dumps(obj, sort_keys=True, indent=2, separators=(',', ': '), default=to_json)
+        
+    def plain(self, obj):
+        '''
+        obj with any models converted to json objects
+        (ujson does not sort the keys of objects returned by default, and outputs them empty)
+        '''
+        if isinstance(obj, model):
+            return obj.to_json()
+        if isinstance(obj, dict):
+            return {key: self.plain(value) for key, value in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return [self.plain(value) for value in obj]
+        return obj
+        
+JSON = json_codec()     #default codec, for logging
+    
+
+class timeseries():
+    '''
+    Append only store of readings, one directory per hub, one file per field per month
+    eg <path>/<hub>/field4-202506.dat
+    records are fixed width (timestamp, value) as little endian doubles, in time order
+    '''
+    RECORD = struct.Struct('<dd')
+    
+    def __init__(self, path, log=None):
+        self.log = log if log else logging.getLogger("Vegehub.api.{}".format(__class__.__name__))
+        self.path = path
+        self.last_ts = {}   #(hub, field): last timestamp stored
+        os.makedirs(self.path, exist_ok=True)
+        
+    def safe_name(self, name):
+        return re.sub(r'[^\w-]', '_', str(name))
+        
+    def segment(self, ts):
+        return time.strftime('%Y%m', time.gmtime(ts))
+        
+    def filename(self, hub, field, segment):
+        return os.path.join(self.path, self.safe_name(hub), '{}-{}.dat'.format(self.safe_name(field), segment))
+        
+    def segments(self, hub, field):
+        '''
+        return sorted list of segments stored for hub field
+        '''
+        prefix = '{}-'.format(self.safe_name(field))
+        try:
+            files = os.listdir(os.path.join(self.path, self.safe_name(hub)))
+        except FileNotFoundError:
+            return []
+        return sorted(f[len(prefix):-4] for f in files if f.startswith(prefix) and f.endswith('.dat'))
+        
+    def get_last_ts(self, hub, field):
+        '''
+        return timestamp of last record stored for hub field
+        '''
+        key = (hub, field)
+        if key not in self.last_ts:
+            self.last_ts[key] = float('-inf')
+            segments = self.segments(hub, field)
+            if segments:
+                with open(self.filename(hub, field, segments[-1]), 'rb') as f:
+                    if f.seek(0, os.SEEK_END) >= self.RECORD.size:
+                        f.seek(-self.RECORD.size, os.SEEK_END)
+                        self.last_ts[key] = self.RECORD.unpack(f.read(self.RECORD.size))[0]
+        return self.last_ts[key]
+        
+    def append(self, hub, field, records):
+        '''
+        append list of (timestamp, value) records for hub field
+        records older than the last one stored are skipped (the store is kept in time order)
+        returns number of records stored
+        '''
+        last = self.get_last_ts(hub, field)
+        segments = {}
+        for ts, value in records:
+            if ts < last:
+                continue
+            segments.setdefault(self.segment(ts), []).append(self.RECORD.pack(ts, value))
+            last = ts
+        if segments:
+            os.makedirs(os.path.join(self.path, self.safe_name(hub)), exist_ok=True)
+        for segment, data in segments.items():
+            with open(self.filename(hub, field, segment), 'ab') as f:
+                f.write(b''.join(data))
+        self.last_ts[(hub, field)] = last
+        stored = sum(len(data) for data in segments.values())
+        if stored < len(records):
+            self.log.debug('%s: %s %s old readings not stored', hub, len(records) - stored, field)
+        return stored
+        
+    def query(self, hub, field, start=None, end=None, step=None):
+        '''
+        return (timestamps, values) for hub field between start and end (inclusive)
+        if step is given, values are averaged over step seconds
+        only the segments in the time range are opened, and they are memory mapped
+        and searched for the start time
+        '''
+        start = float('-inf') if start is None else start
+        end = float('inf') if end is None else end
+        first = self.segment(start) if start > 0 else ''
+        last = self.segment(end) if end < 2**32 else '999999'
+        timestamps, values = [], []
+        bucket = None
+        for segment in self.segments(hub, field):
+            if not first <= segment <= last:
+                continue
+            with open(self.filename(hub, field, segment), 'rb') as f:
+                count = f.seek(0, os.SEEK_END) // self.RECORD.size
+                if not count:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    data = memoryview(m)[:count * self.RECORD.size].cast('d')
+                    index = data[::2]
+                    for i in range(bisect_left(index, start), count):
+                        ts, value = data[2*i], data[2*i+1]
+                        if ts > end:
+                            break
+                        if not step:
+                            timestamps.append(ts)
+                            values.append(value)
+                            continue
+                        ts = ts - ts % step
+                        if ts != bucket:
+                            if bucket is not None:
+                                timestamps.append(bucket)
+                                values.append(total / n)
+                            bucket, total, n = ts, 0, 0
+                        total += value
+                        n += 1
+                    index.release()
+                    data.release()
+        if bucket is not None:
+            timestamps.append(bucket)
+            values.append(total / n)
+        return timestamps, values
+        
+
+class metrics():
+    '''
+    Minimal prometheus style counters, gauges and histograms
+    rendered in the prometheus text format by render()
+    labels are tuples of label values, in the order of the label names given to add()
+    '''
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    
+    def __init__(self, prefix='vegehub_'):
+        self.prefix = prefix
+        self.lock = threading.Lock()    #updated from the event loop, executor and paho threads
+        self.metrics = {}   #name -> (type, help, label names, buckets, {labels: value})
+        
+    def add(self, name, type, help, labels=(), buckets=None):
+        '''
+        declare metric name of type counter, gauge or histogram
+        '''
+        self.metrics[name] = (type, help, labels, tuple(buckets or self.BUCKETS) if type == 'histogram' else None, {})
+        
+    def inc(self, name, labels=(), value=1):
+        values = self.metrics[name][4]
+        with self.lock:
+            values[labels] = values.get(labels, 0) + value
+            
+    def set(self, name, value, labels=()):
+        self.metrics[name][4][labels] = value
+        
+    def observe(self, name, value, labels=()):
+        '''
+        add value to histogram name, bucket counts are stored non cumulative, followed by sum and count
+        '''
+        type, help, label_names, buckets, values = self.metrics[name]
+        with self.lock:
+            counts = values.get(labels)
+            if counts is None:
+                counts = values[labels] = [0] * (len(buckets) + 3)
+            counts[bisect_left(buckets, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+            
+    def label_str(self, names, labels, extra=''):
+        pairs = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in zip(names, labels)]
+        if extra:
+            pairs.append(extra)
+        return '{{{}}}'.format(','.join(pairs)) if pairs else ''
+        
+    def render(self):
+        '''
+        return all metrics in the prometheus text format
+        '''
+        lines = []
+        for name, (type, help, label_names, buckets, values) in self.metrics.items():
+            name = self.prefix + name
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, type))
+            with self.lock:
+                values = [(labels, list(value) if type == 'histogram' else value) for labels, value in values.items()]
+            for labels, value in values:
+                if type != 'histogram':
+                    lines.append('{}{} {}'.format(name, self.label_str(label_names, labels), value))
+                    continue
+                total = 0
+                for le, count in zip(buckets + ('+Inf',), value):
+                    total += count
+                    lines.append('{}_bucket{} {}'.format(name, self.label_str(label_names, labels, 'le="{}"'.format(le)), total))
+                lines.append('{}_sum{} {}'.format(name, self.label_str(label_names, labels), value[-2]))
+                lines.append('{}_count{} {}'.format(name, self.label_str(label_names, labels), value[-1]))
+        return '\n'.join(lines) + '\n'
+        
+
+class replay_filter():
+    '''
+    Drops updates that have already been processed, eg a backlog resent because the response timed out
+    an update is dropped if it's fingerprint is one of the last size seen from the hub, or if it is older
+    than the hub's watermark (the latest created_at processed)
+    watermarks are saved, fingerprints are not, so after a restart updates at the watermark are dropped too
+    updates dated more than MAX_AHEAD in the future (hub clock errors) are only checked by fingerprint,
+    and do not move the watermark, so they can't cause later updates to be dropped
+    '''
+    MAX_AHEAD = 86400   #seconds
+    
+    def __init__(self, size=1000, watermarks=None):
+        self.size = size
+        limit = time.time() + self.MAX_AHEAD
+        self.watermarks = {hub: ts for hub, ts in (watermarks or {}).items() if ts <= limit}  #hub: latest created_at processed (UTC seconds), future ones saved before MAX_AHEAD are dropped
+        self.restored = set(self.watermarks.keys()) #hubs with watermarks loaded, and no fingerprints
+        self.recent = {}    #hub: (set of fingerprints, deque of fingerprints in the order seen)
+        
+    def fingerprint(self, update):
+        return hashlib.blake2b(repr(sorted(update.items())).encode(), digest_size=8).digest()
+        
+    def filter(self, hub, updates):
+        '''
+        return (list of updates not already processed, number dropped), and record them as processed
+        updates without created_at are never dropped
+        '''
+        watermark = self.watermarks.get(hub, 0)
+        restored = hub in self.restored
+        limit = time.time() + self.MAX_AHEAD
+        seen, order = self.recent.setdefault(hub, (set(), deque()))
+        new = []
+        for update in updates:
+            created_at = update.get('created_at')
+            if created_at:
+                ts = utc_timestamp(created_at)
+                if ts < watermark or (restored and ts == watermark):
+                    continue
+                fingerprint = self.fingerprint(update)
+                if fingerprint in seen:
+                    continue
+                seen.add(fingerprint)
+                order.append(fingerprint)
+                if len(order) > self.size:
+                    seen.discard(order.popleft())
+                if ts <= limit:
+                    self.advance(hub, ts)
+            new.append(update)
+        return new, len(updates) - len(new)
+        
+    def advance(self, hub, ts):
+        '''
+        move watermark for hub to ts, returns True if it moved
+        '''
+        if ts > self.watermarks.get(hub, 0):
+            self.watermarks[hub] = ts
+            self.restored.discard(hub)
+            return True
+        return False
+        
+        
+class coordinator():
+    '''
+    Runs worker processes that all serve the web port(s), sharing them with SO_REUSEPORT
+    the server in this process owns the settings, config file, MQTT connection and history store.
+    Workers send it settings changes, MQTT messages and updates to store, and it sends every
+    settings change to all workers, over a unix socket as json lines
+    '''
+    IPC_LIMIT = 2**26   #max message size (whole settings are sent to new workers)
+    
+    def __init__(self, server, count):
+        self.server = server
+        self.log = server.log
+        self.count = count
+        self.dir = tempfile.mkdtemp(prefix='vegehub-')
+        self.path = os.path.join(self.dir, 'coordinator.sock')
+        self.ipc = None
+        self.writers = set()
+        self.processes = []
+        self.task = asyncio.create_task(self.start())
+        
+    async def start(self):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            self.log.error('SO_REUSEPORT is not supported, serving web port(s) from this process')
+            self.server.start_ingest()
+            await self.server.start_web()
+            return
+        self.ipc = await asyncio.start_unix_server(self.handle, self.path, limit=self.IPC_LIMIT)
+        context = multiprocessing.get_context('spawn')
+        level = logging.getLogger('Vegehub').getEffectiveLevel()
+        for i in range(self.count):
+            arg = copy.copy(self.server.arg)
+            arg.worker_socket = self.path
+            arg.worker_index = i
+            process = context.Process(target=run_worker, args=(type(self.server), self.server.webport, arg, level), name='vegehub-worker-{}'.format(i), daemon=True)
+            process.start()
+            self.processes.append(process)
+        self.log.info('Started {} worker processes on port(s) {}'.format(self.count, self.server.webport))
+        
+    async def handle(self, reader, writer):
+        '''
+        receive messages from a worker
+        '''
+        await self.server.settings_loaded.wait()
+        self.writers.add(writer)
+        watermarks = self.server.replays.watermarks if self.server.replays else {}
+        writer.write(self.server.serializer.encode({'op': 'settings', 'settings': self.server.settings, 'watermarks': watermarks}) + b'\n')
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = self.server.serializer.loads(line)
+                op = msg['op']
+                if op == 'publish':
+                    if self.server.mqttc:
+                        for topic, value in msg['messages']:
+                            self.server.queue_message(topic, value)
+                elif op == 'set':
+                    self.server.set_settings(msg['mac'], msg['settings'])
+                    self.server.decode_topics({msg['mac']: self.server.settings[msg['mac']]}, partial=True)
+                    self.server.write_settings()
+                elif op == 'history':
+                    self.server.store_updates(msg['hub'], msg['updates'])
+                elif op == 'watermark':
+                    if self.server.replays and self.server.replays.advance(msg['hub'], msg['ts']):
+                        self.server.watermark_changed(msg['hub'])
+        except (OSError, ValueError, KeyError) as e:
+            self.log.error('Worker connection error: {}'.format(e))
+        except asyncio.CancelledError:
+            pass    #shutting down
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+            
+    def send(self, msg):
+        '''
+        send msg to all workers
+        '''
+        line = self.server.serializer.encode(msg) + b'\n'
+        for writer in self.writers:
+            writer.write(line)
+            
+    async def stop(self):
+        '''
+        stop workers, they send any pending messages before exiting
+        '''
+        if self.task and not self.task.done():
+            self.task.cancel()
+        self.send({'op': 'stop'})
+        loop = asyncio.get_running_loop()
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, 15)
+            if process.is_alive():
+                self.log.warning('Worker {} did not stop, terminating'.format(process.name))
+                process.terminate()
+        for i in range(50):
+            if not self.writers:
+                break
+            await asyncio.sleep(0.1)    #messages from workers still being processed
+        if self.ipc:
+            self.ipc.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+        
+        
+class worker_link():
+    '''
+    Connection from a worker process to the coordinator
+    messages are sent at the end of the current event loop iteration, MQTT messages in one batch
+    '''
+    def __init__(self, server, path):
+        self.server = server
+        self.log = server.log
+        self.path = path
+        self.writer = None
+        self.pending = []   #messages to send
+        self.messages = []  #MQTT messages in the pending publish message
+        self.loop = asyncio.get_running_loop()
+        self.closed = self.loop.create_future()
+        self.task = asyncio.create_task(self.run())
+        
+    async def run(self):
+        '''
+        receive messages from the coordinator, until it stops this worker
+        '''
+        try:
+            reader, self.writer = await asyncio.open_unix_connection(self.path, limit=coordinator.IPC_LIMIT)
+            self.flush()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = self.server.serializer.loads(line)
+                op = msg['op']
+                if op == 'settings':
+                    self.server.settings = self.server.compact_settings(msg['settings'])
+                    self.server.build_index()
+                    self.server.response_cache.clear()
+                    self.server.hub_cache.clear()
+                    self.server.settings_loaded.set()
+                    if self.server.replays:
+                        for hub, ts in msg['watermarks'].items():
+                            self.server.replays.advance(hub, ts)
+                elif op == 'set':
+                    self.server.settings[msg['mac']] = settings_model.from_json(msg['settings'])
+                    self.server.settings_changed(msg['mac'])
+                elif op == 'watermark':
+                    if self.server.replays:
+                        self.server.replays.advance(msg['hub'], msg['ts'])
+                elif op == 'stop':
+                    break
+        except (OSError, ValueError, KeyError) as e:
+            self.log.error('Coordinator connection error: {}'.format(e))
+        finally:
+            if not self.closed.done():
+                self.closed.set_result(True)
+                
+    def send(self, msg):
+        self.pending.append(msg)
+        if len(self.pending) == 1:
+            self.loop.call_soon(self.flush)
+            
+    def publish(self, topic, msg):
+        if not self.messages:
+            self.send({'op': 'publish', 'messages': self.messages})
+        self.messages.append((topic, msg))
+        
+    def flush(self):
+        if self.writer and self.pending and not self.writer.is_closing():
+            self.writer.write(b''.join(self.server.serializer.encode(msg) + b'\n' for msg in self.pending))
+            self.pending = []
+            self.messages = []
+            
+    async def close(self):
+        self.flush()
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.task.cancel()
+        
+        
+class diagnostics():
+    '''
+    Event loop lag monitor, stall watchdog and sampling profiler
+    a task on the event loop records loop lag every interval, a watchdog thread logs the stack of the
+    event loop thread if the task has not run for threshold seconds (eg a blocking call in a callback)
+    the watchdog thread also samples the event loop stack when profiling, written in collapsed stack format
+    (as used by flamegraph.pl and speedscope)
+    '''
+    PROFILE_INTERVAL = 0.005    #seconds between profile samples
+    
+    def __init__(self, threshold=0.1, log=None, metrics=None):
+        self.log = log if log else logging.getLogger("Vegehub.api.{}".format(__class__.__name__))
+        self.metrics = metrics
+        self.threshold = threshold
+        self.interval = min(threshold / 2, 0.05)
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.perf_counter()
+        self.stats = {'max_lag': 0, 'stalls': 0, 'profiling': False}
+        self.profile = None     #{stack: samples} while profiling
+        self.profile_end = 0
+        self.profile_file = None
+        self.stopped = threading.Event()
+        self.task = asyncio.create_task(self.monitor())
+        self.thread = threading.Thread(target=self.watchdog, name='vegehub-watchdog', daemon=True)
+        self.thread.start()
+        self.log.info('Diagnostics enabled, logging event loop stalls over {}s'.format(threshold))
+        
+    async def monitor(self):
+        '''
+        measure event loop lag, the time a sleep of interval overruns by
+        '''
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.heartbeat = time.perf_counter()
+            lag = self.heartbeat - start - self.interval
+            if self.metrics:
+                self.metrics.observe('loop_lag_seconds', lag)
+            self.stats['max_lag'] = max(self.stats['max_lag'], round(lag, 6))
+            if lag > self.threshold:
+                self.log.warning('Event loop lag {:.3f}s'.format(lag))
+                
+    def watchdog(self):
+        '''
+        log the event loop stack if it is blocked, and collect profile samples (runs in it's own thread)
+        '''
+        reported = None
+        while not self.stopped.wait(self.PROFILE_INTERVAL if self.profile is not None else self.interval):
+            now = time.perf_counter()
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            if self.profile is not None:
+                stack = self.collapse_stack(frame)
+                self.profile[stack] = self.profile.get(stack, 0) + 1
+                if now >= self.profile_end:
+                    self.write_profile()
+            stalled = now - self.heartbeat - self.interval
+            if stalled > self.threshold and reported != self.heartbeat:
+                reported = self.heartbeat
+                self.stats['stalls'] += 1
+                self.log.warning('Event loop blocked for {:.3f}s in:\n{}'.format(stalled, ''.join(traceback.format_stack(frame))))
+            del frame
+            
+    def collapse_stack(self, frame):
+        stack = []
+        while frame is not None:
+            stack.append('{} ({}:{})'.format(frame.f_code.co_name, os.path.basename(frame.f_code.co_filename), frame.f_lineno))
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+        
+    def start_profile(self, seconds, filename=None):
+        '''
+        start sampling the event loop stack for seconds, returns the file the profile will be written to
+        raises ValueError if a profile is already running
+        '''
+        if self.profile is not None:
+            raise ValueError('already profiling to {}'.format(self.profile_file))
+        self.profile_file = filename or 'profile-{}.txt'.format(dt.datetime.now().strftime('%Y%m%d-%H%M%S'))
+        self.profile_end = time.perf_counter() + max(0.1, min(seconds, 600))
+        self.stats['profiling'] = True
+        self.profile = {}
+        return self.profile_file
+        
+    def write_profile(self):
+        profile, self.profile = self.profile, None
+        self.stats['profiling'] = False
+        try:
+            with open(self.profile_file, 'w') as f:
+                for stack, count in sorted(profile.items(), key=lambda x: x[1], reverse=True):
+                    f.write('{} {}\n'.format(stack, count))
+            self.log.info('profile of {} samples written to {}'.format(sum(profile.values()), self.profile_file))
+        except OSError as e:
+            self.log.error('Could not write profile: {}'.format(e))
+            
+    def stop(self):
+        self.task.cancel()
+        self.stopped.set()
+        
 
 class FIELD(Enum):
     '''
@@ -442,13 +2504,39 @@ class gateserver(vegehubserver):
     channel 4 is light sensor set periodic, send full report, power sensor 1 second before report
     '''
 
+    #default channel map, field: channel. gate channels are in priority order
+    CHANNELS = {
+        FIELD.SENSOR.value:         {'type': 'gate', 'name': 'sensor'},
+        FIELD.PERIODIC.value:       {'type': 'gate', 'name': 'periodic'},
+        FIELD.SENSOR_BACKUP.value:  {'type': 'gate', 'name': 'sensor'},
+        FIELD.LIGHT.value:          {'type': 'light', 'name': 'light'},
+        FIELD.BATTERY.value:        {'type': 'battery', 'name': 'battery'},
+    }
+    
+    #defaults for each channel type, and topics published (formatted with channel name)
+    CHANNEL_TYPES = {
+        'gate':     {'threshold': 1.0, 'states': ['OPEN', 'CLOSED'],
+                     'topics': ['{}/gate', '{}/gate_last_update']},
+        'light':    {'max': 3.3, 'default': 'Dark',  #Dusk is above IR_offset, added by compile_channels
+                     'levels': [[3.1, 'Very Bright'], [2.7, 'Bright'], [1.17, 'Daylight']],
+                     'topics': ['{}', '{}_value', '{}_lux', '{}_last_update']},
+        'battery':  {'topics': ['{}_volts', '{}', '{}_last_update']},
+        'value':    {'scale': 1.0, 'offset': 0.0, 'round': 3,
+                     'topics': ['{}', '{}_last_update']},
+    }
+
     def __init__(self, webport=None, log=None, arg=None):
         self.log = log if log else logging.getLogger("Vegehub.api.{}".format(__class__.__name__))
         self.arg = arg
         self.hub_id = None
-        self.tz_offset = dt.datetime.now() - dt.datetime.utcnow()
+        self.utc_offset = None  #utc_offset (seconds) from settings of hub being processed
         self.IR_offset = 0.67   #offset created by IR lights from camera
+        self.log_interval = getattr(arg, 'log_interval', 0)   #min seconds between reading INFO logs per hub
+        self.log_times = {}
+        self.batch_decode = getattr(arg, 'batch_decode', 0) #decode backlogs of this many updates or more in one pass
+        self.batch_history = getattr(arg, 'batch_history', False)   #publish backlog history as one message
         super().__init__(webport, self.log, arg)
+        self.channel_tables = self.load_channels(getattr(arg, 'channels', None))
         
     async def process_update(self, post_json):
         '''
@@ -480,19 +2568,95 @@ class gateserver(vegehubserver):
         }
         '''
         self.hub_id = self.get_channel_id(post_json)    #this is the "key" field in FW 3.9
+        self.utc_offset = self.get_utc_offset()
         self.publish("status", "online")
         updates = post_json.get('updates')
         if updates:
-            self.decode_gate(updates)   #process all updates for gate, as we are only interested in the last update
-            for update in updates:
-                self.decode_light(update)
-                self.decode_battery(update)
+            self.store_updates(self.hub_id, updates)
+            gate, readings = self.channel_tables.get(self.hub_id, self.channel_tables['default'])
+            self.decode_gate(updates, gate)   #process all updates for gate, as we are only interested in the last update
+            if self.batch_decode and len(updates) >= self.batch_decode:
+                self.decode_batch(updates, readings)
+            else:
+                for update in updates:
+                    ts = None
+                    for field, decoder, channel in readings:
+                        value = update.get(field)
+                        if value is not None:
+                            ts = ts or self.get_ts(update)
+                            decoder(value, ts, channel)
         else:
-            self.log.warning('No Update in POST:\n{}'.format(pprint(post_json)))
+            self.log.warning('No Update in POST:\n%s', lazy_pprint(post_json))
             
     def publish(self, topic, msg):
         super().publish(topic, msg, self.hub_id)
+        
+    def log_reading(self, reading, msg, *args):
+        '''
+        log reading at INFO level, at most once every log_interval seconds per hub
+        other readings are logged at DEBUG level
+        '''
+        if self.log_interval:
+            key = (self.hub_id, reading)
+            now = time.monotonic()
+            if now - self.log_times.get(key, -self.log_interval) < self.log_interval:
+                self.log.debug(msg, *args)
+                return
+            self.log_times[key] = now
+        self.log.info(msg, *args)
    
+    def load_channels(self, filename=None):
+        '''
+        load channel maps from json file (if given) and compile them into dispatch tables
+        file format is {"default": {field: channel,...}, hub_id: {field: channel,...},...}
+        where channel is {"type": "gate|light|battery|value", "name": topic_name, ...}
+        any defaults in CHANNEL_TYPES can be overridden in the channel
+        returns {hub_id: (gate, readings)}
+        '''
+        channel_maps = {'default': self.CHANNELS}
+        if filename:
+            try:
+                with open(filename, 'rb') as f:
+                    maps = self.serializer.loads(f.read())
+                if not isinstance(maps, dict) or not all(isinstance(m, dict) for m in maps.values()):
+                    raise ValueError('expected {hub_id: {field: channel,...},...}')
+                channel_maps.update(maps)
+            except (OSError, ValueError) as e:
+                self.log.error('Could not load channel maps from {}, using the default channel map: {}'.format(filename, e))
+        return {hub_id: self.compile_channels(channels) for hub_id, channels in channel_maps.items()}
+        
+    def compile_channels(self, channels):
+        '''
+        compile channel map into dispatch table (gate, readings)
+        gate is a list of gate channels in priority order
+        readings is a list of (field, decoder, channel)
+        the light Dusk level defaults to IR_offset
+        '''
+        gate, readings = [], []
+        for field, channel in channels.items():
+            if not isinstance(channel, dict) or not isinstance(channel.get('name'), str):
+                self.log.error('Channel for {} must be an object with a name: {}'.format(field, channel))
+                continue
+            defaults = self.CHANNEL_TYPES.get(channel.get('type'))
+            decoder = getattr(self, 'decode_{}'.format(channel.get('type')), None)
+            if defaults is None or decoder is None:
+                self.log.error('Unknown channel type for {}: {}'.format(field, channel))
+                continue
+            if channel.get('field', field) != field:
+                self.log.warning('Ignoring field {} in channel for {}: {}'.format(channel['field'], field, channel))
+            if channel['type'] == 'light' and 'levels' not in channel:
+                defaults = dict(defaults, levels=defaults['levels'] + [[self.IR_offset, 'Dusk']])
+            channel = dict(defaults, **channel)
+            channel['field'] = field
+            channel['topics'] = [topic.format(channel['name']) for topic in channel['topics']]
+            if 'levels' in channel:
+                channel['levels'] = sorted(channel['levels'], reverse=True)
+            if channel['type'] == 'gate':
+                gate.append(channel)
+            else:
+                readings.append((field, decoder, channel))
+        return gate, readings
+        
     def battery_percent(self,bat_volt):
         '''
         Calculate battery percentage from battery voltage
@@ -514,8 +2678,19 @@ class gateserver(vegehubserver):
         return self.format_date_time(update.get('created_at'))
         
     def format_date_time(self, date_string):
-        date_time =  dt.datetime.now() if not date_string else dt.datetime.strptime(date_string, '%Y-%m-%d %H:%M:%S')+self.tz_offset
-        return date_time.isoformat()
+        if not date_string:
+            return dt.datetime.now().isoformat()
+        return utc_to_local(date_string, self.utc_offset)
+        
+    def get_utc_offset(self):
+        '''
+        return utc_offset in seconds from the settings of the current hub, or None if not known
+        '''
+        offset = self.settings.get(self.get_mac(self.hub_id), {}).get('hub', {}).get('utc_offset')
+        try:
+            return int(offset)
+        except (TypeError, ValueError):
+            return None
         
     def calculate_lux(self, volts):
         # Note, picks up IR from camera, 0.67V - 1V
@@ -526,15 +2701,38 @@ class gateserver(vegehubserver):
         lux = (math.pow(10,max(volts - IR_offset, 0))-1) * 10    #sort of - not really
         return round(lux,2)
         
-    def get_state(self, v):
+    def calculate_lux_batch(self, volts, max_volts=3.3):
+        '''
+        calculate_lux for a list of voltages, returns list
+        '''
+        IR_offset = self.IR_offset
+        if HAVE_NUMPY:
+            v = np.minimum(np.asarray(volts, dtype=float), max_volts)
+            return np.round((np.power(10, np.maximum(v - IR_offset, 0))-1) * 10, 2).tolist()
+        return [self.calculate_lux(min(v, max_volts)) for v in volts]
+        
+    def battery_percent_batch(self, volts):
+        '''
+        battery_percent for a list of voltages, returns list of int
+        '''
+        Vmin = 5.5
+        if HAVE_NUMPY:
+            v = np.asarray(volts, dtype=float)
+            Vmax = np.where(v <= 9.5, 9.0, 12.0)
+            return np.clip(((v - Vmin)/ (Vmax-Vmin) * 100).astype(int), 0, 100).tolist()
+        return [int(self.battery_percent(v)) for v in volts]
+        
+    def get_state(self, v, channel=None):
         '''
         return Gate state OPEN or CLOSED as string.
         If sensor is NO 0 = OPEN 3.3V = CLOSED
         set threshold at 1.0V
         '''
+        if channel:
+            return channel['states'][1] if v > channel['threshold'] else channel['states'][0]
         return 'CLOSED' if v > 1.0 else 'OPEN'
         
-    def decode_gate(self, updates):
+    def decode_gate(self, updates, gate=None):
         '''
         Process updates for gate, we are only interested in the last update for the gate
         We can ignore the rest at we only want the final state.
@@ -546,63 +2744,148 @@ class gateserver(vegehubserver):
         This means we are only interested in the last gate event in the update - as this is the current State
         '''
         update = updates[-1] if isinstance(updates, list) else updates
-        ts = self.get_ts(update)
-        match update:    #python 3.10+ only
-            case {FIELD.SENSOR.value: value}:
-                gate_state = (self.get_state(value), FIELD.SENSOR.name.lower(), ts, FIELD.SENSOR.value)
-            case {FIELD.PERIODIC.value: value}:
-                gate_state = (self.get_state(value), FIELD.PERIODIC.name.lower(), ts, FIELD.PERIODIC.value)
-            case {FIELD.SENSOR_BACKUP.value: value}:
-                gate_state = (self.get_state(value), FIELD.SENSOR.name.lower(), ts, FIELD.SENSOR_BACKUP.value)
-            case _:
-                gate_state = None
-
-        if gate_state:
-            self.log.info('Gate is {}({}) at:{} from: {}'.format(gate_state[0],gate_state[1],gate_state[2],gate_state[3]))    
-            self.publish(gate_state[1]+"/gate", gate_state[0])
-            self.publish(gate_state[1]+"/gate_last_update", gate_state[2])
-            
-    def decode_light(self, update):
-        light = update.get(FIELD.LIGHT.value)
-        ts = self.get_ts(update)
-        IR_offset = self.IR_offset
-        if light is not None: #note, there is 0.67 - 1V offset due to IR lights at night
-            light = min(light, 3.3) #limit max value
-            if  light > 3.1:
-                bright = 'Very Bright'
-            elif  light > 2.7:
-                bright = 'Bright'
-            elif  light > 1.17:
-                bright = 'Daylight'
-            elif  light > IR_offset:
-                bright = 'Dusk'
-            elif  light <= IR_offset:
-                bright = 'Dark'
-            lux = self.calculate_lux(light)
-            self.log.info('Light is {} ({}V, {}lux) at:{} from: {}'.format(bright, light, lux, ts, FIELD.LIGHT.value))
-            self.publish("light", bright)
-            self.publish("light_value", light)
-            self.publish("light_lux", lux)
-            self.publish("light_last_update", ts)
-        
-    def decode_battery(self, update):
-        battery = update.get(FIELD.BATTERY.value)
-        ts = self.get_ts(update)
-        if battery is not None:
-            bat_percent = self.battery_percent(battery)
-            self.log.info('Battery is: {}% at:{} from: {}'.format(bat_percent, ts, FIELD.BATTERY.value))
-            self.publish("battery_volts", battery)
-            self.publish("battery", bat_percent)
-            self.publish("battery_last_update", ts)
+        for channel in gate if gate is not None else self.channel_tables['default'][0]:
+            value = update.get(channel['field'])
+            if value is not None:
+                state = self.get_state(value, channel)
+                ts = self.get_ts(update)
+                self.log_reading('gate', 'Gate is %s(%s) at:%s from: %s', state, channel['name'], ts, channel['field'])
+                self.publish(channel['topics'][0], state)
+                self.publish(channel['topics'][1], ts)
+                break
+            
+    def decode_batch(self, updates, readings=None):
+        '''
+        Process a backlog of updates for readings in one pass.
+        Only the latest state of each reading is published, the backlog is
+        optionally published as one history message per reading eg:
+        light_history: {"ts": [...], "volts": [...], "lux": [...]}
+        '''
+        if readings is None:
+            readings = self.channel_tables['default'][1]
+        columns = {field: ([], []) for field, decoder, channel in readings}
+        last = {}
+        for update in updates:
+            ts = self.get_ts(update) if self.batch_history else None
+            for field, decoder, channel in readings:
+                value = update.get(field)
+                if value is not None:
+                    columns[field][0].append(ts)
+                    columns[field][1].append(value)
+                    last[field] = update
+        self.log.info('Decoded backlog of %s updates (%s)', len(updates), ', '.join('{} {}'.format(len(columns[field][1]), channel['name']) for field, decoder, channel in readings))
+        for field, decoder, channel in readings:
+            if field not in last:
+                continue
+            ts, values = columns[field]
+            decoder(values[-1], self.get_ts(last[field]), channel)
+            if self.batch_history:
+                history = {'ts': ts}
+                if channel['type'] == 'light':
+                    history.update(volts=values, lux=self.calculate_lux_batch(values, channel['max']))
+                elif channel['type'] == 'battery':
+                    history.update(volts=values, percent=self.battery_percent_batch(values))
+                else:
+                    history.update(values=[self.scale_value(v, channel) for v in values])
+                self.publish("{}_history".format(channel['name']), self.serializer.dumps(history))
+            
+    def decode_light(self, light, ts, channel):
+        light = min(light, channel['max']) #limit max value
+        bright = channel['default']
+        for level, name in channel['levels']:
+            if light > level:
+                bright = name
+                break
+        lux = self.calculate_lux(light)
+        self.log_reading(channel['name'], 'Light is %s (%sV, %slux) at:%s from: %s', bright, light, lux, ts, channel['field'])
+        topics = channel['topics']
+        self.publish(topics[0], bright)
+        self.publish(topics[1], light)
+        self.publish(topics[2], lux)
+        self.publish(topics[3], ts)
+        
+    def decode_battery(self, battery, ts, channel):
+        bat_percent = self.battery_percent(battery)
+        self.log_reading(channel['name'], 'Battery is: %s%% at:%s from: %s', bat_percent, ts, channel['field'])
+        topics = channel['topics']
+        self.publish(topics[0], battery)
+        self.publish(topics[1], bat_percent)
+        self.publish(topics[2], ts)
+        
+    def scale_value(self, value, channel):
+        '''
+        convert value to units using channel scale and offset
+        '''
+        return round(value * channel['scale'] + channel['offset'], channel['round'])
+        
+    def decode_value(self, value, ts, channel):
+        value = self.scale_value(value, channel)
+        self.log_reading(channel['name'], '%s is: %s at:%s from: %s', channel['name'], value, ts, channel['field'])
+        topics = channel['topics']
+        self.publish(topics[0], value)
+        self.publish(topics[1], ts)
  
+@lru_cache(maxsize=1024)
+def utc_timestamp(date_string):
+    '''
+    convert UTC date string "YYYY-MM-DD HH:MM:SS" to seconds since the epoch
+    '''
+    try:
+        date_time = dt.datetime.fromisoformat(date_string)
+    except ValueError:
+        date_time = dt.datetime.strptime(date_string, '%Y-%m-%d %H:%M:%S')
+    return date_time.replace(tzinfo=dt.timezone.utc).timestamp()
+    
+@lru_cache(maxsize=1024)
+def utc_to_local(date_string, utc_offset=None):
+    '''
+    convert UTC date string "YYYY-MM-DD HH:MM:SS" to local time in iso format
+    using utc_offset (seconds) if given, otherwise the local timezone at that time (DST aware)
+    '''
+    try:
+        date_time = dt.datetime.fromisoformat(date_string)
+    except ValueError:
+        date_time = dt.datetime.strptime(date_string, '%Y-%m-%d %H:%M:%S')
+    if utc_offset is not None:
+        return (date_time + dt.timedelta(seconds=utc_offset)).isoformat()
+    return date_time.replace(tzinfo=dt.timezone.utc).astimezone().replace(tzinfo=None).isoformat()
+    
 def pprint(obj):
     """Pretty JSON dump of an object."""
-    return json.dumps(obj, sort_keys=True, indent=2, separators=(',', ': ')) 
+    return JSON.pretty(obj)
+    
+class lazy_pprint():
+    """Pretty JSON dump of an object, deferred until it is logged."""
+    __slots__ = ('obj',)
+    
+    def __init__(self, obj):
+        self.obj = obj
+        
+    def __str__(self):
+        return pprint(self.obj)
             
 def sigterm_handler(signal, frame):
     log.info('Received SIGTERM signal')
     sys.exit(0)
 
+def run_worker(server_class, webport, arg, level=logging.INFO):
+    '''
+    worker process started by coordinator, serves webport(s) until the coordinator stops it
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    #the coordinator stops workers
+    log_file = getattr(arg, 'log', 'None')
+    log_file = None if log_file in [None, 'None'] else '{}.worker{}'.format(os.path.expanduser(log_file), arg.worker_index)
+    setup_logger('Vegehub', log_file, level=level, console=True)
+    asyncio.run(worker_main(server_class, webport, arg))
+    
+async def worker_main(server_class, webport, arg):
+    server = server_class(webport=webport, arg=arg)
+    try:
+        await server.startup_task
+        await server.worker.closed
+    finally:
+        await server.cancel()
+
 def setup_logger(logger_name, log_file, level=logging.DEBUG, console=False):
     try: 
         l = logging.getLogger(logger_name)
@@ -638,6 +2921,26 @@ async def main():
     parser.add_argument('-pw','--password', action="store", default=None, help='mqtt broker password. (default: %(default)s)')
     parser.add_argument('-pt','--pub_topic', action="store",default='/vegehub_status/', help='topic to publish vegehub data to. (default: %(default)s)')
     parser.add_argument('-st','--sub_topic', action="store",default='/vegehub_config/', help='topic to send vegehub config to. (default: %(default)s)')
+    parser.add_argument('-pr','--publish_rate', action="store", type=float, default=5000, help='config topics published per second after startup, 0 for no limit (default: %(default)s)')
+    parser.add_argument('-mb','--mqtt_buffer', action="store", type=int, default=10000, help='max number of messages to buffer while mqtt broker is unavailable (default: %(default)s)')
+    parser.add_argument('-mbs','--mqtt_batch', action="store", type=int, default=100, help='number of buffered messages to publish at a time (default: %(default)s)')
+    parser.add_argument('-ms','--mqtt_spool', action="store", default=None, help='file to spool messages to when the buffer is full (default: %(default)s)')
+    parser.add_argument('-ss','--stream_size', action="store", type=int, default=0, help='parse updates larger than this many bytes as they are received, 0 to disable (default: %(default)s)')
+    parser.add_argument('-q','--queue_size', action="store", type=int, default=0, help='queue updates and process after responding to hub, max queue size, 0 to disable (default: %(default)s)')
+    parser.add_argument('-qw','--queue_workers', action="store", type=int, default=1, help='number of workers processing queued updates (default: %(default)s)')
+    parser.add_argument('-qb','--queue_block', action='store_true', help='wait for space when the queue is full instead of returning 503', default = False)
+    parser.add_argument('-ch','--channels', action="store", default=None, help='json file of channel maps for gateserver hubs (default: %(default)s)')
+    parser.add_argument('-bd','--batch_decode', action="store", type=int, default=0, help='decode backlogs of this many updates or more in one pass, publishing only the latest state, 0 to disable (default: %(default)s)')
+    parser.add_argument('-bh','--batch_history', action='store_true', help='publish backlog history as one message per field', default = False)
+    parser.add_argument('-hs','--history', action="store", default=None, help='directory to store reading history in (default: %(default)s)')
+    parser.add_argument('-li','--log_interval', action="store", type=float, default=0, help='min seconds between logging readings at INFO level per hub, 0 logs all (default: %(default)s)')
+    parser.add_argument('-vs','--validate', action='store_true', help='validate configurations against the schema (requires fastjsonschema or jsonschema)', default = False)
+    parser.add_argument('-js','--json', action="store", choices=[name for name, available in json_codec.BACKENDS.items() if available], default=None, help='json library to use (default: fastest installed)')
+    parser.add_argument('-cc','--compact_config', action='store_true', help='write config file as compact json, instead of indented with sorted keys', default = False)
+    parser.add_argument('-wd','--write_delay', action="store", type=float, default=2.0, help='seconds to wait to combine config file writes (default: %(default)s)')
+    parser.add_argument('-dd','--dedupe', action="store", type=int, default=0, help='drop updates already processed, keeping this many recent fingerprints per hub, 0 to disable (default: %(default)s)')
+    parser.add_argument('-w','--workers', action="store", type=int, default=0, help='number of worker processes serving the web port(s), 0 to serve them from one process (default: %(default)s)')
+    parser.add_argument('-dg','--diagnostics', action="store", type=float, default=0, help='log event loop stalls over this many seconds with their stack, and enable /api/profile, 0 is off (default: %(default)s)')
     parser.add_argument('-l','--log', action="store",default="None", help='log file. (default: %(default)s)')
     parser.add_argument('-D','--debug', action='store_true', help='debug mode', default = False)
     parser.add_argument('-V','--version', action='version',version='%(prog)s {version}'.format(version=__VERSION__))
@@ -678,15 +2981,19 @@ async def main():
     if not HAVE_MQTT:
         arg.broker = None
 
+    web = None
     try:
         web = gateserver(webport=arg.server_port, arg=arg)
+        await web.startup_task
         while True:
             await asyncio.sleep(1)
         
-    except (KeyboardInterrupt, SystemExit):
+    except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
         log.info("System exit Received - Exiting program")
         
     finally:
+        if web:
+            await web.cancel()
         log.info("Exited")
         
 if __name__ == '__main__':